@@ -1,11 +1,19 @@
 import os
 import re
+import sys
+import time
+import bisect
 import hashlib
+from pathlib import Path
 from dotenv import load_dotenv
-from pymongo import MongoClient, UpdateOne
+from pymongo import UpdateOne
 from langchain_community.document_loaders import TextLoader, DirectoryLoader
 from langchain_text_splitters import CharacterTextSplitter
-from langchain_huggingface import HuggingFaceEmbeddings
+from image_index import load_image_index, find_image
+from product_codes import normalize_code, is_code
+from resources import get_collection, get_embedding_model
+from quantization import EMBEDDING_STORAGE, compact_fields
+from metrics import METRICS_ENABLED, span, count, summary
 
 # -------------------------------------------------
 # ENV SETUP
@@ -17,16 +25,16 @@ MONGODB_URI = os.getenv("MONGODB_URI")
 if not HF_TOKEN or not MONGODB_URI:
     raise EnvironmentError("Missing HuggingFace token or MongoDB URI")
 
-client = MongoClient(MONGODB_URI)
+# Embedding batch size and optional multi-process encoding (one worker per core)
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "64"))
+EMBED_MULTI_PROCESS = os.getenv("EMBED_MULTI_PROCESS", "false").lower() == "true"
 
-# ⬇️ KEEPING YOUR EXISTING DB + COLLECTION
-db = client["catalog_db"]
-collection = db["Embeddings"]
+# ⬇️ KEEPING YOUR EXISTING DB + COLLECTION (catalog_db.Embeddings, created lazily in resources.py)
 
 # -------------------------------------------------
 # Metadata Enrichment (ONLY ADDING REQUIRED FIELDS)
 # -------------------------------------------------
-def enrich_metadata(chunk):
+def enrich_metadata(chunk, image_index=None):
     text = chunk.page_content.lower()
     source_path = chunk.metadata.get("source", "")
 
@@ -34,7 +42,11 @@ def enrich_metadata(chunk):
     product_name = brand.replace("-", " ").title()
 
     image_dir = "catalog_data/product_images"
-    image_path = None
+    image_file = None
+    sku = model = None
+
+    if image_index is None:
+        image_index = load_image_index(image_dir)
 
     page_number = chunk.metadata.get("page_number", "N/A")
 
@@ -42,27 +54,20 @@ def enrich_metadata(chunk):
     sku_match = re.search(r"\b\d{3,}\b", text)
     if sku_match:
         sku = sku_match.group()
-        for file in os.listdir(image_dir):
-            if file.startswith(sku):
-                image_path = os.path.join(image_dir, file).replace("\\", "/")
-                break
+        image_file = find_image(image_index, name=sku)
 
     # Model match
-    if not image_path:
-        model_match = re.search(r"model\s*[:\-]?\s*([a-z0-9\-]+)", text)
-        if model_match:
-            model = re.sub(r"[^a-z0-9]", "_", model_match.group(1))
-            for file in os.listdir(image_dir):
-                if file.startswith(model):
-                    image_path = os.path.join(image_dir, file).replace("\\", "/")
-                    break
+    model_match = re.search(r"model\s*[:\-]?\s*([a-z0-9\-]+)", text)
+    if model_match:
+        model = re.sub(r"[^a-z0-9]", "_", model_match.group(1))
+        if not image_file:
+            image_file = find_image(image_index, name=model)
 
     # Page fallback image
-    if not image_path and page_number != "N/A":
-        for file in os.listdir(image_dir):
-            if f"_page{page_number}_" in file:
-                image_path = os.path.join(image_dir, file).replace("\\", "/")
-                break
+    if not image_file and page_number != "N/A":
+        image_file = find_image(image_index, page_number=page_number)
+
+    image_path = os.path.join(image_dir, image_file).replace("\\", "/") if image_file else None
 
     # ✅ YOUR REQUESTED LOGIC (ADDED, NOT CHANGED)
     pdf_filename = os.path.basename(source_path).replace(".txt", ".pdf")
@@ -75,7 +80,11 @@ def enrich_metadata(chunk):
         "product_url": None,
         "source_file": os.path.basename(source_path),
         "page_number": page_number,
-        "pdf_path": pdf_path
+        "pdf_path": pdf_path,
+        # Normalized codes for exact SKU / model lookups (see Retrieval.lookup_chunks);
+        # the first number on the page is only kept when it is shaped like a SKU
+        "sku": normalize_code(sku) if sku and is_code(sku) else None,
+        "model": normalize_code(model) if model and is_code(model) else None
     })
 
     return chunk
@@ -83,7 +92,14 @@ def enrich_metadata(chunk):
 # -------------------------------------------------
 # Load Documents
 # -------------------------------------------------
-def load_documents(docs_path="catalog_data/extracted_text"):
+TEXT_FOLDER = "catalog_data/extracted_text"
+
+def text_source(name, folder=TEXT_FOLDER):
+    # metadata.source (and chunk_id prefix) of a catalog's text file. Spelled the way
+    # DirectoryLoader reports it, so every ingestion path agrees on every OS.
+    return str(Path(folder) / f"{name}.txt")
+
+def load_documents(docs_path=TEXT_FOLDER):
     print("\nLoading documents...")
 
     loader = DirectoryLoader(
@@ -94,36 +110,86 @@ def load_documents(docs_path="catalog_data/extracted_text"):
     )
 
     documents = loader.load()
-
     for doc in documents:
-        doc.metadata["source_text"] = doc.page_content
+        doc.metadata["source"] = text_source(Path(doc.metadata["source"]).stem, docs_path)
 
     print(f"Loaded {len(documents)} documents")
     return documents
 
+# -------------------------------------------------
+# Page Spans
+# -------------------------------------------------
+page_marker_pattern = re.compile(r"--- Page (\d+) ---")
+
+def page_markers(text):
+    # ([marker offsets], [page numbers]) for the "--- Page N ---" markers in a document
+    offsets, pages = [], []
+    for match in page_marker_pattern.finditer(text):
+        offsets.append(match.start())
+        pages.append(match.group(1))
+    return offsets, pages
+
+def page_span(markers, start, end):
+    offsets, pages = markers
+    if not offsets:
+        return "N/A", "N/A"
+
+    # Page the chunk starts on: last marker at or before start, else the first marker inside it
+    i = bisect.bisect_right(offsets, start) - 1
+    if i < 0:
+        if offsets[0] >= end:
+            return "N/A", "N/A"
+        i = 0
+
+    # Page the chunk ends on: last marker before its end
+    j = max(bisect.bisect_left(offsets, end) - 1, i)
+    return pages[i], pages[j]
+
 # -------------------------------------------------
 # Split Documents
 # -------------------------------------------------
+def make_splitter(chunk_size=1000, chunk_overlap=100):
+    return CharacterTextSplitter(
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+        add_start_index=True
+    )
+
+def finalize_chunk(chunk, markers, start, image_index):
+    # chunk_id, page span and catalog metadata; start is the chunk's offset in its document
+    source = chunk.metadata.get("source", "unknown")
+    text_hash = hashlib.md5(chunk.page_content.encode("utf-8")).hexdigest()
+    chunk.metadata["chunk_id"] = f"{source}_{text_hash}"
+
+    page_start, page_end = page_span(markers, start, start + len(chunk.page_content))
+    chunk.metadata["page_number"] = page_start
+    chunk.metadata["page_end"] = page_end
+
+    return enrich_metadata(chunk, image_index)
+
 def split_documents(documents, chunk_size=1000, chunk_overlap=100):
     print("\nSplitting documents...")
 
-    splitter = CharacterTextSplitter(
-        chunk_size=chunk_size,
-        chunk_overlap=chunk_overlap
-    )
+    splitter = make_splitter(chunk_size, chunk_overlap)
 
-    chunks = splitter.split_documents(documents)
+    # Page markers per source; the full text itself is not copied into chunk metadata
+    markers_by_source = {
+        doc.metadata.get("source", "unknown"): page_markers(doc.page_content)
+        for doc in documents
+    }
 
-    for chunk in chunks:
-        source = chunk.metadata.get("source", "unknown")
-        text_hash = hashlib.md5(chunk.page_content.encode("utf-8")).hexdigest()
-        chunk.metadata["chunk_id"] = f"{source}_{text_hash}"
+    with span("chunking"):
+        chunks = splitter.split_documents(documents)
 
-        full_text = chunk.metadata.get("source_text", "")
-        page_match = re.search(r"--- Page (\d+) ---", full_text)
-        chunk.metadata["page_number"] = page_match.group(1) if page_match else "N/A"
+        # Built once per run instead of scanning the image folder per chunk
+        image_index = load_image_index("catalog_data/product_images")
 
-        enrich_metadata(chunk)
+        for chunk in chunks:
+            source = chunk.metadata.get("source", "unknown")
+            start = chunk.metadata.pop("start_index", 0)
+            finalize_chunk(chunk, markers_by_source.get(source, ([], [])), start, image_index)
+
+    count("chunks_created", len(chunks))
 
     print(f"Created {len(chunks)} chunks")
     return chunks
@@ -131,43 +197,258 @@ def split_documents(documents, chunk_size=1000, chunk_overlap=100):
 # -------------------------------------------------
 # Store Embeddings
 # -------------------------------------------------
-def store_embeddings(chunks):
-    print("\nGenerating embeddings using Hugging Face...")
+def embedding_update(chunk, vector, ingested_at, storage):
+    fields = {
+        "text": chunk.page_content,
+        "metadata": chunk.metadata,
+        "ingested_at": ingested_at
+    }
+
+    if storage == "float":
+        # Drop the compact fields left by an earlier int8 / binary run
+        fields["embedding"] = vector
+        return {"$set": fields, "$unset": {"embedding_q": "", "embedding_f32": ""}}
+
+    # Compact codes + float32 copy for rescoring (see quantization.py)
+    fields.update(compact_fields(vector, storage))
+    return {"$set": fields, "$unset": {"embedding": ""}}
+
+def embed_chunks(embedding_model, chunks, batch_size=EMBED_BATCH_SIZE, pool=None):
+    # Same preprocessing as HuggingFaceEmbeddings.embed_documents
+    texts = [chunk.page_content.replace("\n", " ") for chunk in chunks]
+
+    with span("embed_batch", multi_process=bool(pool)) as s:
+        if pool:
+            vectors = embedding_model._client.encode_multi_process(
+                texts, pool, batch_size=batch_size
+            ).tolist()
+        else:
+            vectors = embedding_model._client.encode(texts, batch_size=batch_size).tolist()
+        s.set(size=len(texts))
+    count("chunks_embedded", len(texts))
+    return vectors
+
+def write_embeddings(collection, chunks, vectors, ingested_at, storage=EMBEDDING_STORAGE):
+    operations = [
+        UpdateOne(
+            {"chunk_id": chunk.metadata["chunk_id"]},
+            embedding_update(chunk, vector, ingested_at, storage),
+            upsert=True
+        )
+        for chunk, vector in zip(chunks, vectors)
+    ]
 
-    embedding_model = HuggingFaceEmbeddings(
-        model_name="sentence-transformers/all-MiniLM-L6-v2"
-    )
+    with span("bulk_write", collection="embeddings"):
+        collection.bulk_write(operations, ordered=False)
+    count("rows_written", len(operations), collection="embeddings")
+    return len(operations)
+
+def store_embeddings(chunks, batch_size=EMBED_BATCH_SIZE, multi_process=EMBED_MULTI_PROCESS,
+                     storage=EMBEDDING_STORAGE):
+    print(f"\nGenerating embeddings using Hugging Face ({storage} storage)...")
+
+    embedding_model = get_embedding_model()
+    collection = get_collection()
+
+    # Start the sentence-transformers worker pool once for the whole run
+    pool = None
+    if multi_process:
+        pool = embedding_model._client.start_multi_process_pool()
+        print(f"Using multi-process pool with {len(pool['processes'])} workers")
+
+    stored = 0
+    start = time.perf_counter()
+
+    # Re-ingested chunks get a new timestamp, which invalidates cached answers built on them
+    ingested_at = time.time()
+
+    try:
+        for i in range(0, len(chunks), batch_size):
+            batch = chunks[i:i + batch_size]
+            vectors = embed_chunks(embedding_model, batch, batch_size, pool)
 
-    operations = []
+            # Flush each batch as soon as it is embedded
+            stored += write_embeddings(collection, batch, vectors, ingested_at, storage)
+    finally:
+        if pool:
+            embedding_model._client.stop_multi_process_pool(pool)
 
+    elapsed = time.perf_counter() - start
+    if stored:
+        rate = stored / elapsed if elapsed > 0 else float("inf")
+        print(f"Stored/Updated {stored} embeddings in {elapsed:.1f}s ({rate:.1f} chunks/sec, batch_size={batch_size})")
+
+# -------------------------------------------------
+# Incremental Indexing
+# -------------------------------------------------
+# Chunk metadata that can change while the chunk text (and so its chunk_id) stays the same
+REFRESHED_METADATA_FIELDS = ["page_number", "page_end", "image_path", "pdf_path", "sku", "model"]
+
+def stored_chunks(collection, source):
+    # chunk_id -> stored values of REFRESHED_METADATA_FIELDS for one source file
+    projection = {"_id": 0, "chunk_id": 1, **{f"metadata.{f}": 1 for f in REFRESHED_METADATA_FIELDS}}
+    return {
+        doc["chunk_id"]: doc.get("metadata", {})
+        for doc in collection.find({"metadata.source": source}, projection)
+    }
+
+def metadata_changed(chunk, stored_metadata):
+    return any(chunk.metadata.get(f) != stored_metadata.get(f) for f in REFRESHED_METADATA_FIELDS)
+
+def refresh_metadata(collection, chunks, ingested_at):
+    # Kept chunks whose pages or image moved; the new timestamp invalidates cached answers
+    operations = [
+        UpdateOne(
+            {"chunk_id": chunk.metadata["chunk_id"]},
+            {"$set": {
+                **{f"metadata.{f}": chunk.metadata.get(f) for f in REFRESHED_METADATA_FIELDS},
+                "ingested_at": ingested_at
+            }}
+        )
+        for chunk in chunks
+    ]
+    if operations:
+        with span("bulk_write", collection="embeddings"):
+            collection.bulk_write(operations, ordered=False)
+        count("rows_written", len(operations), collection="embeddings")
+    return len(operations)
+
+def remove_deleted_sources(collection, current_sources):
+    # Chunks of source files deleted from disk. A source that is only missing from
+    # this run (failed load, empty run, older path spelling) is left alone.
+    if not current_sources:
+        return 0
+
+    removed = 0
+    for source in collection.distinct("metadata.source"):
+        path = str(source).replace("\\", "/")
+        if source in current_sources or os.path.exists(path):
+            continue
+
+        stale = collection.count_documents({"metadata.source": source})
+        print(f"  {os.path.basename(path)}: text file removed, deleting {stale} chunks")
+        removed += collection.delete_many({"metadata.source": source}).deleted_count
+    return removed
+
+def sync_embeddings(chunks, full=False):
+    print("\nComparing chunks with the Embeddings collection...")
+
+    collection = get_collection()
+
+    # chunk_id = "<source>_<md5 of chunk text>", so an unchanged chunk keeps its id
+    current_by_source = {}
     for chunk in chunks:
-        vector = embedding_model.embed_query(chunk.page_content)
+        source = chunk.metadata.get("source", "unknown")
+        current_by_source.setdefault(source, {})[chunk.metadata["chunk_id"]] = chunk
+
+    to_embed = []
+    to_refresh = []
+    orphans = []
+    added = kept = 0
+
+    for source, current in current_by_source.items():
+        stored = stored_chunks(collection, source)
+
+        new_ids = current.keys() if full else current.keys() - stored.keys()
+        kept_ids = current.keys() & stored.keys()
+        source_orphans = stored.keys() - current.keys()
+        source_refresh = [] if full else [
+            current[chunk_id] for chunk_id in kept_ids
+            if metadata_changed(current[chunk_id], stored[chunk_id])
+        ]
+
+        to_embed.extend(current[chunk_id] for chunk_id in new_ids)
+        to_refresh.extend(source_refresh)
+        orphans.extend(source_orphans)
+        added += len(current.keys() - stored.keys())
+        kept += len(kept_ids)
+
+        print(
+            f"  {os.path.basename(source)}: {len(current.keys() - stored.keys())} new, "
+            f"{len(kept_ids)} kept ({len(source_refresh)} moved), {len(source_orphans)} orphaned"
+        )
+
+    # New chunks are searchable before the stale ones disappear
+    if to_embed:
+        store_embeddings(to_embed)
+    refreshed = refresh_metadata(collection, to_refresh, time.time())
+
+    removed = 0
+    for i in range(0, len(orphans), 1000):
+        removed += collection.delete_many({"chunk_id": {"$in": orphans[i:i + 1000]}}).deleted_count
+
+    # Source files that no longer exist at all
+    removed += remove_deleted_sources(collection, current_by_source.keys())
+
+    print(
+        f"Index sync: {added} added, {kept} kept ({refreshed} metadata updated), {removed} removed"
+        + (f" ({len(to_embed)} re-embedded, --full)" if full else "")
+    )
+
+# -------------------------------------------------
+# Migration: drop metadata.source_text from existing chunks
+# -------------------------------------------------
+def migrate_chunk_metadata(batch_size=500):
+    print("\nMigrating chunk metadata...")
+
+    collection = get_collection()
+    legacy = {"metadata.source_text": {"$exists": True}}
+    migrated = 0
+
+    for source in collection.distinct("metadata.source", legacy):
+        query = {**legacy, "metadata.source": source}
 
-        operations.append(
-            UpdateOne(
-                {"chunk_id": chunk.metadata["chunk_id"]},
+        # Read the full text once per source file, not once per chunk
+        sample = collection.find_one(query, {"metadata.source_text": 1})
+        full_text = sample["metadata"]["source_text"]
+        markers = page_markers(full_text)
+
+        operations = []
+        for doc in collection.find(query, {"_id": 1, "text": 1}):
+            text = doc.get("text", "")
+            start = full_text.find(text)
+            page_start, page_end = page_span(markers, start, start + len(text)) if start >= 0 else ("N/A", "N/A")
+
+            operations.append(UpdateOne(
+                {"_id": doc["_id"]},
                 {
-                    "$set": {
-                        "text": chunk.page_content,
-                        "embedding": vector,
-                        "metadata": chunk.metadata
-                    }
-                },
-                upsert=True
-            )
-        )
+                    "$set": {"metadata.page_number": page_start, "metadata.page_end": page_end},
+                    "$unset": {"metadata.source_text": ""}
+                }
+            ))
 
-    if operations:
-        collection.bulk_write(operations)
-        print(f"Stored/Updated {len(operations)} embeddings")
+            if len(operations) >= batch_size:
+                collection.bulk_write(operations, ordered=False)
+                migrated += len(operations)
+                operations = []
+
+        if operations:
+            collection.bulk_write(operations, ordered=False)
+            migrated += len(operations)
+
+    print(f"Migrated {migrated} chunks")
 
 # -------------------------------------------------
 # MAIN
 # -------------------------------------------------
-def main():
+def main(full=False):
+    collection = get_collection()
+    collection.create_index("chunk_id")
+    collection.create_index("metadata.source")
+    collection.create_index("metadata.sku")
+    collection.create_index("metadata.model")
+
     documents = load_documents()
     chunks = split_documents(documents)
-    store_embeddings(chunks)
+
+    # Only new chunks are embedded; chunks that disappeared are deleted
+    sync_embeddings(chunks, full=full)
+
+    if METRICS_ENABLED:
+        print(f"\nStage timings:\n{summary()}")
 
 if __name__ == "__main__":
-    main()
+    if "--migrate" in sys.argv:
+        migrate_chunk_metadata()
+    else:
+        main(full="--full" in sys.argv)
@@ -1,33 +1,102 @@
 
+import os
+import re
+import math
+from concurrent.futures import ThreadPoolExecutor
 from langchain_core.messages import HumanMessage, AIMessage, SystemMessage
-from langchain_groq import ChatGroq
-from Retrieval import retrieve_documents
+from Retrieval import retrieve_documents, embed_query, normalize_query
+from resources import get_llm
+from context_packer import pack_context, estimate_tokens
+from metrics import METRICS_ENABLED, span, count, count_tokens
+ 
+# "auto" skips the rewrite LLM call for standalone questions, "always" rewrites every follow-up
+REWRITE_MODE = os.getenv("REWRITE_MODE", "auto").lower()
+# Retrieve on the raw query while the rewrite is in flight; reuse it if the rewrite barely changes the query
+SPECULATIVE_RETRIEVAL = os.getenv("SPECULATIVE_RETRIEVAL", "true").lower() == "true"
+SPECULATIVE_REUSE_THRESHOLD = float(os.getenv("SPECULATIVE_REUSE_THRESHOLD", "0.9"))
  
 chat_history = []
-llm = ChatGroq(model="llama-3.3-70b-versatile", temperature=0)
+executor = ThreadPoolExecutor(max_workers=4)
+ 
+# Words that point back at earlier turns ("is it dimmable?", "what about the cheaper one")
+reference_pattern = re.compile(
+    r"\b(it|its|this|these|those|they|them|their|one|ones|same|above|previous|earlier|"
+    r"former|latter|other|another|more|else|cheaper|bigger|smaller)\b"
+    r"|^(and|also|what about|how about|compare)\b",
+    re.I
+)
+ 
+def needs_rewrite(query):
+    if REWRITE_MODE == "always":
+        return True
+ 
+    # Very short questions ("price?", "in white?") almost always depend on context
+    if len(query.split()) <= 3:
+        return True
+ 
+    return bool(reference_pattern.search(query))
+ 
+def similarity(a, b):
+    va, vb = embed_query(a), embed_query(b)
+    dot = sum(x * y for x, y in zip(va, vb))
+    norm = math.sqrt(sum(x * x for x in va)) * math.sqrt(sum(y * y for y in vb))
+    return dot / norm if norm else 0.0
+ 
+def barely_changed(original, rewritten):
+    if normalize_query(original) == normalize_query(rewritten):
+        return True
+    return similarity(original, rewritten) >= SPECULATIVE_REUSE_THRESHOLD
  
 def ask(query):
     original_query = query  # keep for history
  
-    # Step 1 — Rewrite follow-up question if history exists
-    if chat_history:
+    # Step 1 — Rewrite follow-up question if history exists and it is not standalone
+    if chat_history and needs_rewrite(query):
+        speculative = executor.submit(retrieve_documents, query) if SPECULATIVE_RETRIEVAL else None
+ 
         rewrite_prompt = [
             SystemMessage(content="Rewrite the user question into a standalone question using the conversation history. Only return the rewritten question.")
         ] + chat_history + [
             HumanMessage(content=query)
         ]
  
-        query = llm.invoke(rewrite_prompt).content.strip()
-        print(f"[Rewritten Query]: {query}")
- 
-    # Step 2 — Retrieve documents
-    docs = retrieve_documents(query)
+        with span("rewrite"):
+            response = get_llm().invoke(rewrite_prompt)
+        rewritten = response.content.strip()
+        print(f"[Rewritten Query]: {rewritten}")
+        count("rewrites", result="rewritten")
+        if METRICS_ENABLED:
+            count_tokens(
+                response.usage_metadata,
+                sum(estimate_tokens(m.content) for m in rewrite_prompt),
+                estimate_tokens(rewritten),
+                caller="rewrite"
+            )
+ 
+        # Step 2 — Retrieve documents (reuse the speculative result when possible)
+        if speculative and barely_changed(query, rewritten):
+            print("[Speculative retrieval reused]")
+            count("speculative_retrieval", result="reused")
+            docs = speculative.result()
+        else:
+            if speculative:
+                count("speculative_retrieval", result="discarded")
+            docs = retrieve_documents(rewritten)
+ 
+        query = rewritten
+    else:
+        if chat_history:
+            print("[Rewrite skipped: standalone question]")
+            count("rewrites", result="skipped")
+ 
+        # Step 2 — Retrieve documents
+        docs = retrieve_documents(query)
  
     if not docs:
         return "No relevant catalog data found.", []
  
-    # Combine retrieved text
-    context = "\n\n".join(doc["text"] for doc in docs)
+    # Combine retrieved text (near-duplicates and chunk overlap removed)
+    context, _ = pack_context(docs, with_citations=False)
  
     # Step 3 — Answer using retrieved context
     answer_prompt = f"""
@@ -48,7 +117,16 @@ Catalog Context:
 User Question: {query}
 """
  
-    answer = llm.invoke([HumanMessage(content=answer_prompt)]).content
+    with span("generation", caller="history_aware"):
+        response = get_llm().invoke([HumanMessage(content=answer_prompt)])
+    answer = response.content
+    if METRICS_ENABLED:
+        count_tokens(
+            response.usage_metadata,
+            estimate_tokens(answer_prompt),
+            estimate_tokens(answer),
+            caller="history_aware"
+        )
  
     # Step 4 — Save conversation (use ORIGINAL user wording)
     chat_history.append(HumanMessage(content=original_query))
@@ -1,44 +1,109 @@
 import os
+import time
+import atexit
+from itertools import zip_longest
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
-from pymongo import MongoClient
-from langchain_huggingface import HuggingFaceEmbeddings
+import local_index as local_engine
+from ttl_cache import TTLCache
+from product_codes import extract_codes
+from resources import shared, mongo_configured, get_db, get_collection, get_embedding_model
+from quantization import EMBEDDING_STORAGE, VECTOR_INDEX_Q, RESCORE_FACTOR, query_code, rescore
+from metrics import span, count
 
 # -------------------------------------------------
 # Load environment variables
 # -------------------------------------------------
 load_dotenv()
-MONGODB_URI = os.getenv("MONGODB_URI")
 
-if not MONGODB_URI:
-    raise EnvironmentError("MONGODB_URI not found in .env file")
+# "atlas" = MongoDB Atlas $vectorSearch, "local" = in-process index (local_index.py)
+RETRIEVAL_BACKEND = os.getenv("RETRIEVAL_BACKEND", "atlas").lower()
+
+# Query-embedding cache: size, TTL (seconds) and optional file to persist it across restarts
+QUERY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", "1024"))
+QUERY_CACHE_TTL = float(os.getenv("QUERY_CACHE_TTL", "86400"))
+QUERY_CACHE_PATH = os.getenv("QUERY_CACHE_PATH")
+
+# Resolve SKU / model codes in the query with exact indexed lookups before vector search
+EXACT_LOOKUP = os.getenv("EXACT_LOOKUP", "true").lower() == "true"
+
+# Concurrent vector searches in retrieve_documents_batch
+RETRIEVAL_BATCH_WORKERS = int(os.getenv("RETRIEVAL_BATCH_WORKERS", "8"))
 
 # -------------------------------------------------
-# MongoDB connection
+# Shared resources (MongoDB client, embedding model and local index are
+# created lazily on first use, see resources.py)
 # -------------------------------------------------
-try:
-    client = MongoClient(MONGODB_URI)
-    db = client["catalog_db"]
-    collection = db["Embeddings"]
-    print("Connected to MongoDB")
-except Exception as e:
-    raise ConnectionError(f"Failed to connect to MongoDB: {e}")
+def get_local_index():
+    def load():
+        index = local_engine.load_local_index()
+        print(f"Loaded local vector index ({index['matrix'].shape[0]} vectors)")
+        return index
+
+    return shared("local_index", load)
 
 # -------------------------------------------------
-# Embedding model
+# Query embedding cache
 # -------------------------------------------------
-embedding_model = HuggingFaceEmbeddings(
-    model_name="sentence-transformers/all-MiniLM-L6-v2"
-)
+query_cache = TTLCache(max_size=QUERY_CACHE_SIZE, ttl=QUERY_CACHE_TTL)
+
+if QUERY_CACHE_PATH:
+    print(f"Loaded {query_cache.load(QUERY_CACHE_PATH)} cached query embeddings")
+    atexit.register(query_cache.save, QUERY_CACHE_PATH)
+
+def normalize_query(query):
+    # MiniLM is uncased, so case and whitespace do not change the vector
+    return " ".join(query.lower().split())
+
+def embed_query(query):
+    key = normalize_query(query)
+    vector = query_cache.get(key)
+    count("query_cache", result="miss" if vector is None else "hit")
+    if vector is None:
+        with span("query_embedding"):
+            vector = get_embedding_model().embed_query(key)
+        query_cache.put(key, vector)
+    return vector
+
+def query_cache_stats():
+    return query_cache.stats()
 
 # -------------------------------------------------
-# Retrieval function (FINAL)
+# Search backends
 # -------------------------------------------------
-def retrieve_documents(query, k=5):
-    print(f"\nUser Query: {query}")
+# Only the metadata fields formatted_results needs (never the chunk's source document)
+RESULT_PROJECTION = {
+    "_id": 0,
+    "text": 1,
+    "ingested_at": 1,
+    "metadata.product_name": 1,
+    "metadata.page_number": 1,
+    "metadata.page_end": 1,
+    "metadata.image_path": 1,
+    "metadata.pdf_path": 1,
+    "metadata.source_file": 1,
+    "metadata.chunk_id": 1
+}
 
-    query_vector = embedding_model.embed_query(query)
+# Pipeline and post-processing are shared with the async service (service.py)
+def atlas_pipeline(query_vector, k):
+    if EMBEDDING_STORAGE != "float":
+        # Approximate pass over the int8 / binary index, exact rescoring on embedding_f32
+        limit = k * RESCORE_FACTOR
+        return [
+            {
+                "$vectorSearch": {
+                    "index": VECTOR_INDEX_Q,
+                    "path": "embedding_q",
+                    "queryVector": query_code(query_vector),
+                    "numCandidates": max(100, limit * 10),
+                    "limit": limit
+                }
+            },
+            {"$project": {**RESULT_PROJECTION, "embedding_f32": 1}}
+        ]
 
-    pipeline = [
+    return [
         {
             "$vectorSearch": {
                 "index": "vector_index",
@@ -50,32 +115,185 @@ def retrieve_documents(query, k=5):
         },
         {
             "$project": {
-                "_id": 0,
-                "text": 1,
-                "metadata": 1,
+                **RESULT_PROJECTION,
                 "score": {"$meta": "vectorSearchScore"}
             }
         }
     ]
 
-    results = list(collection.aggregate(pipeline))
-    print(f"Retrieved {len(results)} documents")
+def atlas_results(results, query_vector, k):
+    if EMBEDDING_STORAGE != "float":
+        return rescore(results, query_vector, k)
+    return results
+
+def atlas_search(query_vector, k):
+    results = list(get_collection().aggregate(atlas_pipeline(query_vector, k)))
+    return atlas_results(results, query_vector, k)
+
+def local_search(query_vector, k):
+    return local_engine.search(get_local_index(), query_vector, k)
 
-    if not results:
+SEARCH_BACKENDS = {
+    "atlas": atlas_search,
+    "local": local_search
+}
+
+# -------------------------------------------------
+# Exact SKU / model lookup (db.prices + chunk metadata)
+# -------------------------------------------------
+def price_code_filter(codes):
+    return {"$or": [{"sku_key": {"$in": codes}}, {"model_key": {"$in": codes}}]}
+
+PRICE_CODE_PROJECTION = {"_id": 0, "sku_key": 1, "model_key": 1}
+
+def lookup_products(query, limit=10):
+    codes = extract_codes(query)
+    if not codes or not mongo_configured():
+        return []
+
+    return list(get_db().prices.find(price_code_filter(codes), {"_id": 0}).limit(limit))
+
+def confirmed_codes(codes, records):
+    # Letter + digit codes stand on their own; bare numbers (prices, quantities)
+    # only count when db.prices knows them as a SKU or model
+    known = {r.get("sku_key") for r in records} | {r.get("model_key") for r in records}
+    return [c for c in codes if not c.isdigit() or c in known]
+
+def exact_chunk_filter(codes):
+    return {"$or": [{"metadata.sku": {"$in": codes}}, {"metadata.model": {"$in": codes}}]}
+
+def lookup_chunks(query, k):
+    codes = extract_codes(query)
+    if not codes or not mongo_configured():
         return []
 
+    numeric = [c for c in codes if c.isdigit()]
+    if numeric:
+        codes = confirmed_codes(codes, get_db().prices.find(price_code_filter(numeric), PRICE_CODE_PROJECTION))
+        if not codes:
+            return []
+
+    return list(get_collection().find(exact_chunk_filter(codes), RESULT_PROJECTION).limit(k))
+
+def merge_exact(results, exact, k):
+    # Interleave the two rankings (exact hit first at each rank). Exact hits keep
+    # the vector score when vector search found them too, and never get a made-up one.
+    scores = {r.get("metadata", {}).get("chunk_id"): r.get("score") for r in results}
+    for r in exact:
+        r["match"] = "exact"
+        score = scores.get(r.get("metadata", {}).get("chunk_id"))
+        if score is not None:
+            r["score"] = score
+
+    merged = []
+    seen = set()
+    for pair in zip_longest(exact, results):
+        for r in pair:
+            if r is None:
+                continue
+            chunk_id = r.get("metadata", {}).get("chunk_id")
+            if chunk_id not in seen:
+                seen.add(chunk_id)
+                merged.append(r)
+    return merged[:k]
+
+# -------------------------------------------------
+# Retrieval function (FINAL)
+# -------------------------------------------------
+def search_documents(query, query_vector, k=5, verbose=True):
+    with span("vector_search", backend=RETRIEVAL_BACKEND, storage=EMBEDDING_STORAGE):
+        results = SEARCH_BACKENDS[RETRIEVAL_BACKEND](query_vector, k)
+
+    if EXACT_LOOKUP:
+        with span("exact_lookup"):
+            exact = lookup_chunks(query, k)
+        if exact:
+            results = merge_exact(results, exact, k)
+            if verbose:
+                print(f"Exact SKU/model match on {len(exact)} chunks")
+
+    if verbose:
+        print(f"Retrieved {len(results)} documents")
+
+    return format_results(results)
+
+def format_results(results):
     formatted_results = []
     for r in results:
         meta = r.get("metadata", {})
 
+        page_number = meta.get("page_number")
+        page_end = meta.get("page_end")
+        if page_end and page_end != page_number:
+            page_number = f"{page_number}-{page_end}"
+
         formatted_results.append({
             "text": r.get("text", ""),
             "score": r.get("score", 0),
+            "match": r.get("match", "vector"),
             "product_name": meta.get("product_name"),
-            "page_number": meta.get("page_number"),
+            "page_number": page_number,
             "image_path": meta.get("image_path"),
             "pdf_path": meta.get("pdf_path"),
-            "source_file": meta.get("source_file")
+            "source_file": meta.get("source_file"),
+            "chunk_id": meta.get("chunk_id"),
+            "ingested_at": r.get("ingested_at")
         })
 
     return formatted_results
+
+def retrieve_documents(query, k=5):
+    print(f"\nUser Query: {query}")
+
+    query_vector = embed_query(query)
+    return search_documents(query, query_vector, k)
+
+# -------------------------------------------------
+# Batch retrieval (evaluation replays, cache warming)
+# -------------------------------------------------
+def embed_queries(queries):
+    keys = [normalize_query(q) for q in queries]
+
+    vectors = {}
+    missing = []
+    for key in dict.fromkeys(keys):
+        vector = query_cache.get(key)
+        if vector is None:
+            missing.append(key)
+        else:
+            vectors[key] = vector
+
+    count("query_cache", len(keys) - len(missing), result="hit")
+    count("query_cache", len(missing), result="miss")
+
+    # One batched model call for every query not already cached
+    if missing:
+        with span("query_embedding_batch") as s:
+            embedded = get_embedding_model().embed_documents(missing)
+            s.set(size=len(missing))
+        for key, vector in zip(missing, embedded):
+            query_cache.put(key, vector)
+            vectors[key] = vector
+
+    return [vectors[key] for key in keys]
+
+def retrieve_documents_batch(queries, k=5, max_workers=RETRIEVAL_BATCH_WORKERS):
+    start = time.perf_counter()
+    query_vectors = embed_queries(queries)
+    embedded = time.perf_counter()
+
+    # Results come back in input order; at most max_workers searches in flight
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        results = list(pool.map(
+            lambda args: search_documents(*args, k=k, verbose=False),
+            zip(queries, query_vectors)
+        ))
+
+    end = time.perf_counter()
+    total = end - start
+    print(
+        f"Batch retrieval: {len(queries)} queries in {total:.2f}s "
+        f"({len(queries) / total if total > 0 else float('inf'):.1f} queries/sec; "
+        f"embedding {embedded - start:.2f}s, search {end - embedded:.2f}s, {max_workers} workers)"
+    )
+    return results
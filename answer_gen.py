@@ -1,30 +1,183 @@
-from langchain_groq import ChatGroq
+import os
+import math
+import hashlib
+import time
 from langchain_core.messages import SystemMessage, HumanMessage, AIMessage
-from Retrieval import retrieve_documents
+from Retrieval import retrieve_documents, embed_query, lookup_products
+from ttl_cache import TTLCache
+from resources import get_llm
+from context_packer import pack_context, estimate_tokens
+from metrics import METRICS_ENABLED, span, count, observe, count_tokens
+
+# Semantic answer cache: answers are reused for near-identical questions
+# (cosine >= threshold) over the same retrieved chunks
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "512"))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "3600"))
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95"))
  
-llm = ChatGroq(
-    model="llama-3.3-70b-versatile",
-    temperature=0
-)
+# Answer price/spec questions about a single SKU/model straight from db.prices (no LLM call)
+DIRECT_ANSWERS = os.getenv("DIRECT_ANSWERS", "false").lower() == "true"
+STRUCTURED_KEYWORDS = ["price", "cost", "mrp", "watt", "volt", "spec", "power",
+                       "capacity", "dimension", "weight"]
  
-chat_history = [
-    SystemMessage(content="You are a product catalog assistant. Answer ONLY using provided catalog data and always cite source file and page number.")
-]
+# Per-session chat history: prior turns are kept as bare question/answer pairs
+# within a token budget; optionally older turns are rolled up into a summary
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "1500"))
+HISTORY_SUMMARY = os.getenv("HISTORY_SUMMARY", "false").lower() == "true"
+MAX_SESSIONS = int(os.getenv("MAX_SESSIONS", "1000"))
+SESSION_TTL = float(os.getenv("SESSION_TTL", "86400"))
  
-def answer_question(query):
-    docs = retrieve_documents(query)
+SYSTEM_PROMPT = "You are a product catalog assistant. Answer ONLY using provided catalog data and always cite source file and page number."
  
-    if not docs:
-        return "No relevant catalog data found in the catalog.", []
+# session id -> {"turns": [(question, answer), ...], "summary": str}
+sessions = TTLCache(max_size=MAX_SESSIONS, ttl=SESSION_TTL, touch=True)
+ 
+# answer signature (history digest + chunk signature) -> [(query_vector, answer), ...]
+answer_cache = TTLCache(max_size=ANSWER_CACHE_SIZE, ttl=ANSWER_CACHE_TTL)
+ 
+def cosine_similarity(a, b):
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm else 0.0
+ 
+def chunk_signature(docs):
+    # ingested_at changes whenever a chunk is re-ingested, invalidating old entries
+    return tuple(sorted(f"{d.get('chunk_id')}@{d.get('ingested_at')}" for d in docs))
+ 
+def history_digest(session_id):
+    # Summary + turns that condition the answer (see history_messages)
+    session = get_session(session_id)
+    digest = hashlib.sha256(session["summary"].encode("utf-8"))
+    for question, answer in session["turns"]:
+        digest.update(f"\0{question}\0{answer}".encode("utf-8"))
+    return digest.hexdigest()
+ 
+def answer_signature(docs, session_id):
+    # Only sessions with the same history share answers, so a follow-up like
+    # "is it dimmable?" is never answered from another conversation
+    return (history_digest(session_id),) + chunk_signature(docs)
+ 
+def cached_answer(signature, query_vector):
+    for vector, answer in answer_cache.get(signature, []):
+        if cosine_similarity(query_vector, vector) >= ANSWER_CACHE_THRESHOLD:
+            return answer
+    return None
+ 
+def cache_answer(signature, query_vector, answer):
+    entries = answer_cache.pop(signature, [])
+    answer_cache.put(signature, (entries + [(query_vector, answer)])[-8:])
+ 
+def get_session(session_id):
+    session = sessions.get(session_id)
+    if session is None:
+        session = {"turns": [], "summary": ""}
+        sessions.put(session_id, session)
+    return session
+ 
+def summary_messages(summary, turns):
+    transcript = "\n".join(f"User: {q}\nAssistant: {a}" for q, a in turns)
+    if summary:
+        transcript = f"Earlier summary: {summary}\n\n{transcript}"
+ 
+    return [
+        SystemMessage(content="Summarize this conversation between a user and a product catalog assistant in a few sentences. Keep product names, SKUs and prices that were discussed."),
+        HumanMessage(content=transcript)
+    ]
+ 
+def summarize_turns(summary, turns):
+    with span("history_summary"):
+        response = get_llm().invoke(summary_messages(summary, turns))
+    return response.content.strip()
+ 
+def record_turn(session_id, question, answer, summarize=True):
+    # With summarize=False the turns that need summarizing are returned instead,
+    # for callers that run the summary themselves (service.py)
+    session = get_session(session_id)
+    session["turns"].append((question, answer))
+ 
+    used = estimate_tokens(session["summary"]) + sum(
+        estimate_tokens(q) + estimate_tokens(a) for q, a in session["turns"]
+    )
+ 
+    dropped = []
+    while len(session["turns"]) > 1 and used > HISTORY_TOKEN_BUDGET:
+        q, a = session["turns"].pop(0)
+        used -= estimate_tokens(q) + estimate_tokens(a)
+        dropped.append((q, a))
+ 
+    if not dropped or not HISTORY_SUMMARY:
+        return []
+    if not summarize:
+        return dropped
+    session["summary"] = summarize_turns(session["summary"], dropped)
+    return []
+ 
+def history_messages(session_id):
+    session = get_session(session_id)
+    system = SYSTEM_PROMPT
+    if session["summary"]:
+        system += f"\n\nSummary of the earlier conversation: {session['summary']}"
  
-    context_blocks = []
-    for d in docs:
-        citation = f"(Source: {d.get('source_file')} | Page: {d.get('page_number')})"
-        context_blocks.append(d["text"] + "\n" + citation)
+    messages = [SystemMessage(content=system)]
+    for question, answer in session["turns"]:
+        messages.append(HumanMessage(content=question))
+        messages.append(AIMessage(content=answer))
+    return messages
  
-    context = "\n\n".join(context_blocks)
+def field(record, name):
+    value = record.get(name)
+    # pandas writes missing CSV cells as NaN
+    if value is None or (isinstance(value, float) and math.isnan(value)) or value == "":
+        return None
+    return value
  
-    prompt = f"""
+def direct_answer(query):
+    if not any(k in query.lower() for k in STRUCTURED_KEYWORDS):
+        return None
+ 
+    records = lookup_products(query)
+    products = {(r.get("sku_key"), r.get("model_key")) for r in records}
+    if len(products) != 1:
+        return None  # no match or ambiguous -> normal RAG path
+ 
+    record = records[0]
+    name = field(record, "product_name") or field(record, "sku")
+    lines = [f"**{name}** ({field(record, 'brand')})"]
+    if field(record, "sku"):
+        lines.append(f"- SKU: {field(record, 'sku')}")
+    if field(record, "price"):
+        lines.append(f"- Price: {field(record, 'price')}")
+    if field(record, "specs"):
+        lines.append(f"- Specs: {field(record, 'specs')}")
+    lines.append("(Source: db.prices)")
+    answer = "\n".join(lines)
+ 
+    doc = {
+        "text": answer,
+        "match": "exact",
+        "product_name": name,
+        "page_number": None,
+        "image_path": None,
+        "pdf_path": None,
+        "source_file": "db.prices"
+    }
+    return answer, [doc]
+ 
+def log_latency(query, start, first_token_at, source):
+    end = time.perf_counter()
+    first_token_at = first_token_at or end
+    count("answers", source=source)
+    observe("answer_seconds", end - start, source=source)
+    print(
+        f"[latency] {source}: ttft={first_token_at - start:.3f}s "
+        f"total={end - start:.3f}s query={query!r}"
+    )
+ 
+def build_prompt(query, docs):
+    # Drops near-duplicate chunks and overlap, keeps each chunk's citation line
+    context, _ = pack_context(docs)
+ 
+    return f"""
 Use ONLY the product catalog data below to answer.
 Always include citation like (Source: file | Page X).
  
@@ -34,8 +187,69 @@ Catalog Data:
 User Question: {query}
 """
  
-    chat_history.append(HumanMessage(content=prompt))
-    response = llm.invoke(chat_history)
-    chat_history.append(AIMessage(content=response.content))
+def stream_answer(query, session_id="default"):
+    # Returns (docs, tokens): docs are available as soon as retrieval finishes,
+    # tokens is a generator yielding the answer as the LLM produces it
+    start = time.perf_counter()
+ 
+    if DIRECT_ANSWERS:
+        direct = direct_answer(query)
+        if direct:
+            print("Answered from db.prices")
+            record_turn(session_id, query, direct[0])
+            log_latency(query, start, None, "direct")
+            return direct[1], iter([direct[0]])
+ 
+    docs = retrieve_documents(query)
+ 
+    if not docs:
+        return [], iter(["No relevant catalog data found in the catalog."])
+ 
+    query_vector = embed_query(query)
+    signature = answer_signature(docs, session_id)
+    answer = cached_answer(signature, query_vector)
+ 
+    if answer is not None:
+        print("Answer cache hit")
+        record_turn(session_id, query, answer)
+        log_latency(query, start, None, "cache")
+        return docs, iter([answer])
+ 
+    prompt = build_prompt(query, docs)
+ 
+    def tokens():
+        # Only this turn carries the catalog context; history holds bare Q/A
+        messages = history_messages(session_id) + [HumanMessage(content=prompt)]
+        first_token_at = None
+        parts = []
+        usage = None
+ 
+        with span("generation", caller="answer_gen") as s:
+            for chunk in get_llm().stream(messages):
+                usage = getattr(chunk, "usage_metadata", None) or usage
+                if not chunk.content:
+                    continue
+                if first_token_at is None:
+                    first_token_at = time.perf_counter()
+                    observe("time_to_first_token_seconds", first_token_at - start)
+                parts.append(chunk.content)
+                yield chunk.content
+            s.set(chunks=len(parts))
+ 
+        answer = "".join(parts)
+        if METRICS_ENABLED:
+            count_tokens(
+                usage,
+                sum(estimate_tokens(m.content) for m in messages),
+                estimate_tokens(answer),
+                caller="answer_gen"
+            )
+        record_turn(session_id, query, answer)
+        cache_answer(signature, query_vector, answer)
+        log_latency(query, start, first_token_at, "llm")
+ 
+    return docs, tokens()
  
-    return response.content, docs
+def answer_question(query, session_id="default"):
+    docs, tokens = stream_answer(query, session_id)
+    return "".join(tokens), docs
@@ -1,5 +1,9 @@
+import uuid
 import streamlit as st
-from answer_gen import answer_question
+from service import ask, get_loop, ServiceBusy, warm_up as warm_up_service
+from resources import warm_up
+from metrics import start_metrics_server
+from Retrieval import RETRIEVAL_BACKEND, get_local_index
 from langchain_core.messages import HumanMessage, AIMessage
 
 # ---------------- PAGE CONFIG ----------------
@@ -11,10 +15,31 @@ st.set_page_config(
 st.title("📘 CMS Product Catalog Assistant")
 st.caption("Ask questions from Philips / Legrand product catalogs")
 
+# ---------------- SHARED RESOURCES ----------------
+# Mongo client, embedding model, LLM and the async service loop (service.py) are
+# built once per process and shared by every browser session
+@st.cache_resource(show_spinner="⏳ Loading catalog assistant...")
+def load_resources():
+    # Prometheus /metrics endpoint when METRICS_ENABLED and METRICS_PORT are set
+    start_metrics_server()
+    get_loop()
+    warm_up_service()
+    if RETRIEVAL_BACKEND == "local":
+        get_local_index()
+    # Mongo is warmed whenever it is configured: the local backend still uses it
+    # for exact SKU/model lookups
+    return warm_up()
+
+load_resources()
+
 # ---------------- SESSION STATE ----------------
 if "chat_history" not in st.session_state:
     st.session_state.chat_history = []
 
+# Keys this browser session's LLM history in answer_gen
+if "session_id" not in st.session_state:
+    st.session_state.session_id = uuid.uuid4().hex
+
 # ---------------- CHAT DISPLAY ----------------
 for msg in st.session_state.chat_history:
     if msg["role"] == "user":
@@ -33,27 +58,47 @@ if user_query:
         "content": user_query
     })
 
-    with st.spinner("🔍 Searching catalog..."):
-        answer, docs = answer_question(user_query)
+    try:
+        with st.spinner("🔍 Searching catalog..."):
+            docs, tokens = ask(user_query, st.session_state.session_id)
+    except ServiceBusy as e:
+        st.warning(str(e))
+        st.stop()
+
+    # Show assistant answer as it streams; sources render right after retrieval
+    with st.chat_message("assistant"):
+        answer_placeholder = st.empty()
+        answer_placeholder.markdown("▌")
+
+        # ---------------- SOURCES ----------------
+        if docs:
+            with st.expander("📚 View Sources"):
+                for i, d in enumerate(docs, start=1):
+                    st.markdown(f"### 🔹 Source {i}")
+                    st.markdown(f"**Product:** {d.get('product_name', 'N/A')}")
+                    st.markdown(f"**File:** `{d.get('source_file')}`")
+                    st.markdown(f"**Page:** {d.get('page_number')}")
+                    if d.get("match") == "exact":
+                        st.markdown("**Match:** exact SKU/model")
+                    if d.get("score"):
+                        st.markdown(f"**Relevance Score:** `{round(d['score'], 4)}`")
+
+                    if d.get("image_path"):
+                        st.image(d["image_path"], width=250)
+
+                    st.markdown("---")
+
+        answer = ""
+        try:
+            for token in tokens:
+                answer += token
+                answer_placeholder.markdown(answer + "▌")
+        except ServiceBusy as e:
+            # Waited too long for a free LLM slot
+            answer = answer or str(e)
+        answer_placeholder.markdown(answer)
 
-    # Show assistant answer
-    st.chat_message("assistant").markdown(answer)
     st.session_state.chat_history.append({
         "role": "assistant",
         "content": answer
     })
-
-    # ---------------- SOURCES ----------------
-    if docs:
-        with st.expander("📚 View Sources"):
-            for i, d in enumerate(docs, start=1):
-                st.markdown(f"### 🔹 Source {i}")
-                st.markdown(f"**Product:** {d.get('product_name', 'N/A')}")
-                st.markdown(f"**File:** `{d.get('source_file')}`")
-                st.markdown(f"**Page:** {d.get('page_number')}")
-                st.markdown(f"**Relevance Score:** `{round(d.get('score', 0), 4)}`")
-
-                if d.get("image_path"):
-                    st.image(d["image_path"], width=250)
-
-                st.markdown("---")
@@ -0,0 +1,486 @@
+"""
+Offline end-to-end benchmark of the catalog pipeline: ingestion, chunking,
+embedding, retrieval and answer generation, with local stand-ins so no
+Atlas, Groq or Tesseract setup is needed:
+
+  - MongoDB: mongomock (pip install mongomock); vector search runs on the
+    local index (RETRIEVAL_BACKEND=local) exported from it
+  - LLM: deterministic fake chat model with a fixed per-token delay
+  - Embeddings: hashing bag-of-words vectors, or the real MiniLM model
+    with --real-embeddings
+  - Catalogs: synthetic PDFs with a text layer and product images, plus a
+    golden query set built from the products they contain
+
+Reports per-stage throughput, p50/p95/p99 latency and peak traced memory
+(tracemalloc, disable with --no-memory) and recall@k on the golden queries.
+Results are written as JSON; pass an earlier file with --baseline to
+print the change per stage.
+
+    python benchmarks/bench_pipeline.py [--catalogs 2] [--pages 30] [--queries 40]
+        [--k 5] [--repeat 3] [--output results.json] [--baseline old.json]
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import random
+import shutil
+import hashlib
+import inspect
+import argparse
+import platform
+import tempfile
+import contextlib
+import tracemalloc
+import numpy as np
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(REPO_DIR, "benchmarks", "results")
+sys.path.insert(0, REPO_DIR)
+
+# -------------------------------------------------
+# Stand-ins
+# -------------------------------------------------
+class HashingEmbeddings:
+    """Deterministic bag-of-words vectors with the HuggingFaceEmbeddings interface."""
+
+    def __init__(self, dim=384):
+        self.dim = dim
+        self._client = self  # Embedding.store_embeddings calls _client.encode
+
+    def encode(self, texts, batch_size=32, **kwargs):
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for token in re.findall(r"[a-z0-9]+", text.lower()):
+                digest = hashlib.md5(token.encode("utf-8")).digest()
+                bucket = int.from_bytes(digest[:4], "little") % self.dim
+                vectors[row, bucket] += 1 if digest[4] & 1 else -1
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        return vectors / norms
+
+    def embed_documents(self, texts):
+        return self.encode(texts).tolist()
+
+    def embed_query(self, text):
+        return self.encode([text])[0].tolist()
+
+class FakeChatModel:
+    """Deterministic stand-in for ChatGroq (invoke / stream)."""
+
+    def __init__(self, token_delay=0.002, answer_tokens=60):
+        self.token_delay = token_delay
+        self.answer_tokens = answer_tokens
+        self.calls = 0
+
+    def respond(self, messages):
+        from langchain_core.messages import HumanMessage
+
+        self.calls += 1
+
+        if "Rewrite the user question" in messages[0].content:
+            # Resolve the follow-up to the last model mentioned in the conversation
+            question = messages[-1].content
+            history = " ".join(m.content for m in messages[1:-1] if isinstance(m, HumanMessage))
+            models = re.findall(r"LD-\d+", history)
+            return [f"{question} (model {models[-1]})" if models else question]
+
+        prompt = messages[-1].content
+        rng = random.Random(hashlib.md5(prompt.encode("utf-8")).hexdigest())
+        words = re.findall(r"\S+", prompt) or ["ok"]
+        return [rng.choice(words) + " " for _ in range(self.answer_tokens)]
+
+    def invoke(self, messages):
+        from langchain_core.messages import AIMessage
+
+        tokens = self.respond(messages)
+        time.sleep(self.token_delay * len(tokens))
+        return AIMessage(content="".join(tokens).strip())
+
+    def stream(self, messages):
+        from langchain_core.messages import AIMessageChunk
+
+        for token in self.respond(messages):
+            time.sleep(self.token_delay)
+            yield AIMessageChunk(content=token)
+
+# -------------------------------------------------
+# Synthetic catalogs + golden queries
+# -------------------------------------------------
+FILLER = [
+    "Energy efficient lighting for homes and offices.",
+    "Available in warm white, neutral white and cool daylight.",
+    "Warranty terms apply as per company policy.",
+    "Ideal for living rooms, bedrooms and corridors.",
+]
+PRODUCT_TYPES = ["Slim Downlighter", "Surface Panel", "Bulkhead", "Batten", "Spotlight", "Strip Light"]
+QUERY_TEMPLATES = [
+    "What is the price of model LD-{n}?",
+    "What is the wattage of LD-{n}?",
+    "Show details for the LD-{n} {kind}",
+]
+
+def make_catalogs(pdf_dir, catalogs, pages, products_per_page=3, seed=7):
+    import fitz
+
+    rng = random.Random(seed)
+    os.makedirs(pdf_dir, exist_ok=True)
+
+    # One logo repeated on every page (exercises image blob dedup)
+    logo = fitz.Pixmap(fitz.csRGB, fitz.IRect(0, 0, 48, 48), False)
+    logo.set_rect(logo.irect, (200, 30, 30))
+
+    products = []
+    for c in range(catalogs):
+        brand = f"bench-catalog-{c + 1}"
+        doc = fitz.open()
+        for page_number in range(1, pages + 1):
+            page = doc.new_page()
+            lines = [f"{brand.title()} - page {page_number}", rng.choice(FILLER)]
+
+            for _ in range(products_per_page):
+                n = rng.randint(10000, 99999)
+                kind = rng.choice(PRODUCT_TYPES)
+                lines += [
+                    "",
+                    f"Model: LD-{n} {kind}",
+                    f"SKU: {n}",
+                    f"Power: {rng.randint(3, 60)} Watt, {rng.choice([110, 230])} Volt",
+                    f"Cutout {rng.randint(50, 200)} mm, weight {rng.random():.2f} kg",
+                    rng.choice(FILLER),
+                    f"MRP Rs. {rng.randint(100, 9999)}.00",
+                ]
+                products.append({"brand": brand, "page": page_number, "model": f"LD-{n}", "kind": kind})
+
+            page.insert_textbox(fitz.Rect(50, 50, 545, 700), "\n".join(lines), fontsize=10)
+
+            photo = fitz.Pixmap(fitz.csRGB, fitz.IRect(0, 0, 64, 64), False)
+            photo.set_rect(photo.irect, (rng.randrange(256), rng.randrange(256), rng.randrange(256)))
+            page.insert_image(fitz.Rect(400, 720, 464, 784), pixmap=photo)
+            page.insert_image(fitz.Rect(50, 740, 98, 788), pixmap=logo)
+
+        doc.save(os.path.join(pdf_dir, f"{brand}.pdf"))
+        doc.close()
+
+    return products
+
+def golden_queries(products, count, seed=11):
+    rng = random.Random(seed)
+    picked = rng.sample(products, min(count, len(products)))
+    return [
+        {
+            "query": rng.choice(QUERY_TEMPLATES).format(n=p["model"][3:], kind=p["kind"].lower()),
+            "expected": p["model"],
+            "source_file": f"{p['brand']}.txt",
+            "page": p["page"]
+        }
+        for p in picked
+    ]
+
+def recall(results, golden, k):
+    # A query is answered when a retrieved chunk contains the product's model code
+    hits_1 = hits_k = 0
+    for docs, item in zip(results, golden):
+        found = [item["expected"] in d.get("text", "") for d in docs[:k]]
+        hits_1 += bool(found[:1] and found[0])
+        hits_k += any(found)
+    n = len(golden) or 1
+    return {"recall@1": hits_1 / n, f"recall@{k}": hits_k / n, "queries": len(golden)}
+
+# -------------------------------------------------
+# Measurement
+# -------------------------------------------------
+@contextlib.contextmanager
+def quiet(verbose=False):
+    if verbose:
+        yield
+        return
+    with open(os.devnull, "w", encoding="utf-8") as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+def measure(fn, inputs, items, unit, memory=True, verbose=False):
+    latencies = []
+    results = []
+
+    if memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+
+    with quiet(verbose):
+        for args in inputs:
+            call_start = time.perf_counter()
+            results.append(fn(*args))
+            latencies.append(time.perf_counter() - call_start)
+
+    seconds = time.perf_counter() - start
+    peak = None
+    if memory:
+        peak = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        tracemalloc.stop()
+
+    p50, p95, p99 = (np.percentile(latencies, [50, 95, 99]) * 1000).tolist() if latencies else (0, 0, 0)
+    stats = {
+        "calls": len(latencies),
+        "items": items,
+        "unit": unit,
+        "seconds": round(seconds, 4),
+        "throughput": round(items / seconds, 2) if seconds > 0 else None,
+        "p50_ms": round(p50, 2),
+        "p95_ms": round(p95, 2),
+        "p99_ms": round(p99, 2),
+        "peak_mb": round(peak, 2) if peak is not None else None
+    }
+    return stats, results
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / (2 ** 20 if sys.platform == "darwin" else 2 ** 10), 1)
+
+# -------------------------------------------------
+# Benchmark
+# -------------------------------------------------
+def patch_mongomock_bulk(bulk_builder):
+    # pymongo >= 4.11 passes sort= to bulk updates / replaces, which mongomock does not accept
+    for name in ("add_update", "add_replace"):
+        method = getattr(bulk_builder, name)
+        if "sort" in inspect.signature(method).parameters:
+            continue
+
+        def without_sort(self, *args, _method=method, sort=None, **kwargs):
+            return _method(self, *args, **kwargs)
+
+        setattr(bulk_builder, name, without_sort)
+
+def check_session_isolation(answer_gen, llm, golden):
+    # The same follow-up in two sessions with different histories must reach the LLM twice
+    answer_gen.answer_cache.clear()
+    with quiet(False):
+        for i, item in enumerate(golden[:2]):
+            answer_gen.answer_question(item["query"], f"isolation-{i}")
+
+        calls = llm.calls
+        for i in range(2):
+            answer_gen.answer_question("Is it dimmable please tell", f"isolation-{i}")
+
+    if llm.calls - calls != 2:
+        raise SystemExit("❌ A follow-up was answered from another session's cached answer")
+
+def run(args, workdir):
+    try:
+        import mongomock
+        from mongomock.collection import BulkOperationBuilder
+    except ImportError:
+        raise SystemExit("mongomock is required for the MongoDB stand-in: pip install mongomock")
+    import pymongo
+
+    patch_mongomock_bulk(BulkOperationBuilder)
+
+    # Everything below reads its configuration at import time
+    os.chdir(workdir)
+    os.environ.update({
+        "MONGODB_URI": "mongodb://localhost/bench",  # never contacted, see the patch below
+        "HUGGINGFACEHUB_API_TOKEN": os.getenv("HUGGINGFACEHUB_API_TOKEN") or "offline",
+        "TESSERACT_PATH": os.getenv("TESSERACT_PATH") or "tesseract",
+        "POPPLER_PATH": os.getenv("POPPLER_PATH") or workdir,
+        "RETRIEVAL_BACKEND": "local",
+        "LOCAL_INDEX_DIR": os.path.join(workdir, "local_index"),
+        "EMBEDDING_STORAGE": "float",
+        "QUERY_CACHE_PATH": "",
+        "DIRECT_ANSWERS": "false",
+    })
+    pymongo.MongoClient = mongomock.MongoClient
+
+    products = make_catalogs("catalog_data/pdf_catalogs", args.catalogs, args.pages)
+    golden = golden_queries(products, args.queries)
+
+    with quiet(args.verbose):
+        import resources
+        if not args.real_embeddings:
+            resources.instances["embedding_model"] = HashingEmbeddings()
+        resources.instances["llm"] = FakeChatModel(token_delay=args.token_delay)
+
+        import ingestion
+        import Embedding
+        import local_index
+        import Retrieval
+        import answer_gen
+        import History_aware
+        import metrics
+        import pipeline
+
+    stages = {}
+    common = {"memory": not args.no_memory, "verbose": args.verbose}
+    pages = args.catalogs * args.pages
+
+    print(f"Synthetic catalogs: {args.catalogs} x {args.pages} pages, {len(products)} products")
+
+    stages["process_all_pdfs"], _ = measure(
+        ingestion.process_all_pdfs, [()] * args.repeat, pages * args.repeat, "pages", **common
+    )
+
+    with quiet(args.verbose):
+        documents = Embedding.load_documents()
+
+    stages["split_documents"], results = measure(
+        Embedding.split_documents, [(documents,)] * args.repeat, 0, "chunks", **common
+    )
+    chunks = results[-1]
+    stages["split_documents"]["items"] = len(chunks) * args.repeat
+    stages["split_documents"]["throughput"] = round(len(chunks) * args.repeat / stages["split_documents"]["seconds"], 2)
+
+    stages["store_embeddings"], _ = measure(
+        Embedding.store_embeddings, [(chunks,)] * args.repeat, len(chunks) * args.repeat, "chunks", **common
+    )
+
+    stages["export_local_index"], _ = measure(
+        local_index.export_collection, [(resources.get_collection(),)], len(chunks), "chunks", **common
+    )
+    with quiet(args.verbose):
+        Retrieval.get_local_index()
+
+    queries = [item["query"] for item in golden]
+
+    # Cold query-embedding cache, so every query pays for its embedding
+    Retrieval.query_cache.clear()
+    stages["retrieve_documents"], retrieved = measure(
+        Retrieval.retrieve_documents, [(q, args.k) for q in queries], len(queries), "queries", **common
+    )
+    quality = recall(retrieved, golden, args.k)
+
+    Retrieval.query_cache.clear()
+    answer_gen.answer_cache.clear()
+    answer_gen.sessions.clear()
+    stages["answer_question"], _ = measure(
+        answer_gen.answer_question,
+        [(q, f"bench-{i}") for i, q in enumerate(queries)],
+        len(queries), "queries", **common
+    )
+
+    check_session_isolation(answer_gen, resources.get_llm(), golden)
+
+    # Two-turn conversations: a product question, then a follow-up that needs a rewrite
+    def conversation_turn(query, new_conversation):
+        if new_conversation:
+            History_aware.chat_history.clear()
+        return History_aware.ask(query)
+
+    turns = []
+    for q in queries:
+        turns += [(q, True), ("Is it dimmable?", False)]
+
+    Retrieval.query_cache.clear()
+    stages["history_aware_ask"], _ = measure(conversation_turn, turns, len(turns), "turns", **common)
+
+    # Streaming ingestion (pipeline.py) re-embedding every chunk, for comparison with the batch stages
+    stages["streaming_pipeline"], results = measure(
+        pipeline.run_pipeline, [(ingestion.PDF_FOLDER, True)], pages, "pages", **common
+    )
+    stages["streaming_pipeline"]["first_searchable_s"] = results[-1]["first_searchable"]
+
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {
+            "catalogs": args.catalogs,
+            "pages": args.pages,
+            "products": len(products),
+            "chunks": len(chunks),
+            "queries": len(queries),
+            "k": args.k,
+            "repeat": args.repeat,
+            "embeddings": resources.EMBEDDING_MODEL_NAME if args.real_embeddings else "hashing",
+            "llm_token_delay": args.token_delay,
+            "memory_tracing": not args.no_memory,
+            "python": platform.python_version(),
+            "platform": platform.platform()
+        },
+        "stages": stages,
+        "retrieval_quality": quality,
+        "peak_rss_mb": peak_rss_mb(),
+        # Per-stage spans and counters when run with METRICS_ENABLED=true
+        "metrics": metrics.snapshot() if metrics.METRICS_ENABLED else None,
+        "golden_queries": golden
+    }
+
+# -------------------------------------------------
+# Report
+# -------------------------------------------------
+def print_report(results, baseline=None):
+    print(f"\n{'stage':<20} {'throughput':>18} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'peak MB':>8}")
+    for name, s in results["stages"].items():
+        throughput = f"{s['throughput']} {s['unit']}/s"
+        peak = "-" if s["peak_mb"] is None else s["peak_mb"]
+        print(f"{name:<20} {throughput:>18} {s['p50_ms']:>9} {s['p95_ms']:>9} {s['p99_ms']:>9} {peak:>8}")
+
+    quality = ", ".join(f"{k}={v:.3f}" for k, v in results["retrieval_quality"].items() if k != "queries")
+    print(f"\nRetrieval quality ({results['retrieval_quality']['queries']} golden queries): {quality}")
+    print(f"Peak RSS: {results['peak_rss_mb']} MB")
+
+    if not baseline:
+        return
+
+    def change(new, old):
+        return f"{(new - old) / old * 100:+.1f}%" if new is not None and old else "n/a"
+
+    print(f"\nChange vs baseline ({baseline['timestamp']}):")
+    for name, s in results["stages"].items():
+        old = baseline["stages"].get(name)
+        if old:
+            print(
+                f"{name:<20} throughput {change(s['throughput'], old['throughput']):>8}  "
+                f"p95 {change(s['p95_ms'], old['p95_ms']):>8}  peak {change(s['peak_mb'], old['peak_mb']):>8}"
+            )
+    for key, value in results["retrieval_quality"].items():
+        old = baseline.get("retrieval_quality", {}).get(key)
+        if key != "queries" and old is not None:
+            print(f"{key:<20} {old:.3f} -> {value:.3f}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline end-to-end pipeline benchmark")
+    parser.add_argument("--catalogs", type=int, default=2)
+    parser.add_argument("--pages", type=int, default=30, help="pages per catalog")
+    parser.add_argument("--queries", type=int, default=40, help="golden queries")
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--repeat", type=int, default=3, help="runs of the ingestion/embedding stages")
+    parser.add_argument("--token-delay", type=float, default=0.002, help="fake LLM seconds per token")
+    parser.add_argument("--real-embeddings", action="store_true", help="use the MiniLM model instead of hashing vectors")
+    parser.add_argument("--no-memory", action="store_true", help="skip tracemalloc (lower timing overhead)")
+    parser.add_argument("--output", help="results JSON (default: benchmarks/results/pipeline-<time>.json)")
+    parser.add_argument("--baseline", help="earlier results JSON to compare against")
+    parser.add_argument("--keep-workdir", action="store_true")
+    parser.add_argument("--verbose", action="store_true", help="show pipeline output")
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output or os.path.join(
+        RESULTS_DIR, f"pipeline-{time.strftime('%Y%m%d-%H%M%S')}.json"
+    ))
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+
+    cwd = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix="catalog-bench-")
+    try:
+        results = run(args, workdir)
+    finally:
+        os.chdir(cwd)
+        if args.keep_workdir:
+            print(f"Work directory kept at {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+
+    print_report(results, baseline)
+    print(f"\nResults saved → {output}")
+
+if __name__ == "__main__":
+    main()
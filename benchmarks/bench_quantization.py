@@ -0,0 +1,92 @@
+"""
+Benchmark: recall@k of quantized first-pass search + float32 rescoring
+against exact float search. Uses the exported local index when present
+(python local_index.py), otherwise synthetic clustered vectors.
+
+    python benchmarks/bench_quantization.py [k] [queries]
+"""
+
+import os
+import sys
+import time
+import bson
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from local_index import LOCAL_INDEX_DIR, top_k, code_norms, code_scores
+from quantization import rescore_factor, quantize_int8, quantize_binary, compact_fields
+
+# -------------------------------------------------
+# Data
+# -------------------------------------------------
+def synthetic_vectors(n=20000, dim=384, clusters=200, seed=0):
+    # Clustered unit vectors, roughly like sentence embeddings of a catalog
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(clusters, dim))
+    vectors = centers[rng.integers(clusters, size=n)] + rng.normal(scale=0.6, size=(n, dim))
+    vectors = vectors.astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+def load_vectors():
+    path = os.path.join(LOCAL_INDEX_DIR, "vectors.npy")
+    if os.path.exists(path):
+        print(f"Using exported index at {LOCAL_INDEX_DIR}")
+        return np.asarray(np.load(path, mmap_mode="r"))
+    print("No exported index found, using synthetic vectors")
+    return synthetic_vectors()
+
+# -------------------------------------------------
+# Measure
+# -------------------------------------------------
+def recall_at_k(matrix, codes, kind, queries, k, factor):
+    norms = code_norms(codes) if kind == "int8" else None
+    hits = 0
+    elapsed = 0.0
+    for query in queries:
+        exact = set(top_k(matrix @ query, k).tolist())
+
+        start = time.perf_counter()
+        candidates = top_k(code_scores(codes, kind, query, norms), k * factor)
+        rescored = candidates[top_k(matrix[candidates] @ query, k)]
+        elapsed += time.perf_counter() - start
+
+        hits += len(exact & set(rescored.tolist()))
+
+    return hits / (k * len(queries)), elapsed / len(queries) * 1000
+
+def main(k=10, n_queries=200):
+    matrix = load_vectors()
+    rng = np.random.default_rng(1)
+
+    # Queries: stored vectors with noise, so each has real near neighbours
+    queries = matrix[rng.choice(len(matrix), size=n_queries, replace=False)]
+    queries = queries + rng.normal(scale=0.02, size=queries.shape).astype(np.float32)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+
+    start = time.perf_counter()
+    for query in queries:
+        top_k(matrix @ query, k)
+    float_ms = (time.perf_counter() - start) / n_queries * 1000
+
+    # BSON bytes per document: the indexed field alone, and every vector field stored.
+    # The compact modes keep the float32 copy for rescoring, so documents shrink far
+    # less than the indexed field does.
+    float_doc = len(bson.encode({"embedding": matrix[0].tolist()}))
+    print(f"\n{len(matrix)} vectors x {matrix.shape[1]} dims, k={k}, {n_queries} queries")
+    print(f"{'':<22} {'recall':>8} {'ms':>11}  {'indexed B':>9} {'stored B':>8}")
+    print(f"{'float32 exact':<22} {'1.000':>8} {float_ms:>8.2f} ms  {float_doc:>9} {float_doc:>8}")
+
+    for kind, quantize in (("int8", quantize_int8), ("binary", quantize_binary)):
+        codes = quantize(matrix)
+        fields = compact_fields(matrix[0], kind)
+        indexed = len(bson.encode({"embedding_q": fields["embedding_q"]}))
+        stored = len(bson.encode(fields))
+        for factor in sorted({1, 4, 16, rescore_factor(kind)}):
+            recall, ms = recall_at_k(matrix, codes, kind, queries, k, factor)
+            label = f"{kind} x{factor} rescore"
+            print(f"{label:<22} {recall:>8.3f} {ms:>8.2f} ms  {indexed:>9} {stored:>8} ({float_doc / stored:.1f}x smaller)")
+
+if __name__ == "__main__":
+    args = [int(a) for a in sys.argv[1:3]]
+    main(*args)
@@ -0,0 +1,125 @@
+"""
+Benchmark: structured_parser vs the original line-by-line loop from
+ingestion.extract_structured_data. Fails if the records differ.
+
+    python benchmarks/bench_structured_parser.py [pages]
+"""
+
+import os
+import re
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from product_codes import product_key
+from structured_parser import parse_structured_text
+
+# -------------------------------------------------
+# Reference: the original extraction loop
+# -------------------------------------------------
+def legacy_parse(text, brand_name):
+    lines = text.split("\n")
+
+    products = []
+    current = {
+        "brand": brand_name,
+        "product_name": "",
+        "sku": "",
+        "price": "",
+        "specs": []
+    }
+
+    price_pattern = r"(₹\s?\d+[,\d]*\.?\d*|Rs\.?\s?\d+[,\d]*\.?\d*)"
+    sku_pattern = r"(SKU[:\s\-]*[A-Z0-9\-]+)"
+    model_pattern = r"(Model[:\s\-]*[A-Z0-9\-]+)"
+
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+
+        if re.search(sku_pattern, line, re.I):
+            current["sku"] = re.sub(r"SKU|:", "", line, flags=re.I).strip()
+
+        if re.search(model_pattern, line, re.I):
+            current["product_name"] = re.sub(r"Model|:", "", line, flags=re.I).strip()
+
+        price_match = re.search(price_pattern, line)
+        if price_match:
+            current["price"] = price_match.group()
+            current["specs"] = "; ".join(current["specs"])
+            current["sku_key"] = product_key(current["sku"])
+            current["model_key"] = product_key(current["product_name"])
+            products.append(current.copy())
+            current = {
+                "brand": brand_name,
+                "product_name": "",
+                "sku": "",
+                "price": "",
+                "specs": []
+            }
+            continue
+
+        if any(k in line.lower() for k in ["watt", "volt", "mm", "kg", "capacity", "power"]):
+            current["specs"].append(line)
+
+    return products
+
+# -------------------------------------------------
+# Sample catalog text
+# -------------------------------------------------
+FILLER = [
+    "Energy efficient lighting for homes and offices",
+    "Available in multiple colour temperatures",
+    "Warranty terms apply as per company policy",
+    "Ideal for living rooms, bedrooms and corridors",
+    "",
+    "   ",
+]
+
+def sample_text(pages=300, seed=7):
+    rng = random.Random(seed)
+    out = []
+    for page in range(1, pages + 1):
+        out.append(f"\n\n--- Page {page} ---")
+        for _ in range(rng.randint(3, 8)):
+            for _ in range(rng.randint(5, 20)):
+                out.append(rng.choice(FILLER))
+            n = rng.randint(100, 99999)
+            out.append(f"Model: LD-{n} Slim Downlighter")
+            if rng.random() < 0.7:
+                out.append(f"SKU: {n}{rng.choice(['', 'A', '-B'])}")
+            out.append(f"Power: {rng.randint(3, 60)} Watt, {rng.choice([110, 230])} Volt")
+            out.append(f"Cutout {rng.randint(50, 200)} mm  weight {rng.random():.2f} kg")
+            if rng.random() < 0.1:
+                out.append("sku power-1 (capacity note) \r")
+            if rng.random() < 0.1:
+                # A price or unit pattern must not join a line to the next one
+                out.append(rng.choice(["Lasts 25000 hours", "Price Rs.", "Rs", "MRP ₹"]))
+                out.append(rng.choice([f"{rng.randint(1, 9)} Watt", f"{rng.randint(100, 900)} mm cutout", "5 year warranty"]))
+            out.append(rng.choice([f"MRP ₹ {rng.randint(100, 9999)}.00", f"Rs. {rng.randint(1, 9)},{rng.randint(100, 999)}"]))
+    return "\n".join(out)
+
+def best_of(fn, repeat=5):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+if __name__ == "__main__":
+    pages = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    text = sample_text(pages)
+
+    legacy_time, legacy_records = best_of(lambda: legacy_parse(text, "philips"))
+    new_time, new_records = best_of(lambda: parse_structured_text(text, "philips"))
+
+    if legacy_records != new_records:
+        raise SystemExit("❌ structured_parser output differs from the original parser")
+
+    print(f"Sample: {pages} pages, {len(text.splitlines())} lines, {len(new_records)} records (outputs identical)")
+    print(f"original loop     : {legacy_time * 1000:.1f} ms")
+    print(f"structured_parser : {new_time * 1000:.1f} ms ({legacy_time / new_time:.1f}x)")
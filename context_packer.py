@@ -0,0 +1,95 @@
+"""
+Context packing for the answer prompt.
+
+Takes the ranked retrieval results and builds the "Catalog Data" block
+within a token budget: near-duplicate chunks (word-shingle Jaccard) are
+dropped, text shared with an already packed chunk (the splitter's chunk
+overlap) is trimmed, and every surviving chunk keeps its citation line.
+"""
+
+import os
+
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "3000"))
+CONTEXT_DUPLICATE_THRESHOLD = float(os.getenv("CONTEXT_DUPLICATE_THRESHOLD", "0.8"))
+SHINGLE_SIZE = 5
+MIN_OVERLAP_CHARS = 20
+MAX_OVERLAP_CHARS = 300  # a little above Embedding.split_documents' chunk_overlap
+
+def estimate_tokens(text):
+    # ~4 characters per token for English text; avoids loading a tokenizer
+    return len(text) // 4 + 1
+
+def shingles(text, n=SHINGLE_SIZE):
+    words = text.lower().split()
+    if len(words) <= n:
+        return {tuple(words)}
+    return {tuple(words[i:i + n]) for i in range(len(words) - n + 1)}
+
+def jaccard(a, b):
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+def overlap_length(left, right):
+    # Longest suffix of `left` that is also a prefix of `right`
+    for size in range(min(len(left), len(right), MAX_OVERLAP_CHARS), MIN_OVERLAP_CHARS - 1, -1):
+        if left.endswith(right[:size]):
+            return size
+    return 0
+
+def trim_overlaps(text, packed_texts):
+    for other in packed_texts:
+        head = overlap_length(other, text)
+        if head:
+            text = text[head:]
+        tail = overlap_length(text, other)
+        if tail:
+            text = text[:-tail]
+    return text.strip()
+
+def citation(doc):
+    return f"(Source: {doc.get('source_file')} | Page: {doc.get('page_number')})"
+
+def pack_context(docs, token_budget=CONTEXT_TOKEN_BUDGET, with_citations=True):
+    blocks = []
+    packed = []          # docs that made it into the context
+    packed_texts = []    # their original (untrimmed) text
+    packed_shingles = []
+    used = 0
+    duplicates = 0
+
+    for doc in docs:
+        original = doc.get("text", "").strip()
+        doc_shingles = shingles(original)
+
+        if any(jaccard(doc_shingles, s) >= CONTEXT_DUPLICATE_THRESHOLD for s in packed_shingles):
+            duplicates += 1
+            continue
+
+        text = trim_overlaps(original, packed_texts)
+        if not text:
+            duplicates += 1
+            continue
+
+        block = f"{text}\n{citation(doc)}" if with_citations else text
+        cost = estimate_tokens(block)
+
+        if used + cost > token_budget:
+            if blocks:
+                continue  # a shorter lower-ranked chunk may still fit
+            # Always keep (a prefix of) the best chunk
+            suffix = f"\n{citation(doc)}" if with_citations else ""
+            block = text[:max(0, token_budget * 4 - len(suffix))] + suffix
+            cost = estimate_tokens(block)
+
+        blocks.append(block)
+        packed.append(doc)
+        packed_texts.append(original)
+        packed_shingles.append(doc_shingles)
+        used += cost
+
+    print(
+        f"Packed {len(packed)}/{len(docs)} chunks into ~{used} tokens "
+        f"({duplicates} near-duplicates dropped)"
+    )
+    return "\n\n".join(blocks), packed
@@ -0,0 +1,84 @@
+"""
+Image index for catalog_data/product_images.
+
+Maps image name stems (SKU / model / "<brand>_page<N>") and page numbers to
+image files so metadata enrichment can resolve images with dict lookups
+instead of scanning the folder for every chunk. The index is persisted next
+to the images as index.json and kept up to date by ingestion.py.
+"""
+
+import os
+import re
+import json
+
+INDEX_FILENAME = "index.json"
+
+stem_pattern = re.compile(r"^(.*)_\d+\.[^.]+$")
+page_pattern = re.compile(r"_page(\d+)_")
+
+def normalize_name(name):
+    # "__LD-98" (image stem) and "ld_98" (chunk text) resolve to the same key
+    return re.sub(r"[^a-z0-9]+", "_", name.lower()).strip("_")
+
+def empty_index():
+    return {"names": {}, "pages": {}, "count": 0}
+
+def add_image(index, filename):
+    stem_match = stem_pattern.match(filename)
+    stem = stem_match.group(1) if stem_match else os.path.splitext(filename)[0]
+    index["names"].setdefault(normalize_name(stem), filename)
+
+    page_match = page_pattern.search(filename)
+    if page_match:
+        index["pages"].setdefault(page_match.group(1), filename)
+
+def list_images(image_dir):
+    # Only top-level image files; the blobs/ store is not indexed by name
+    with os.scandir(image_dir) as entries:
+        return sorted(
+            e.name for e in entries
+            if e.is_file() and e.name != INDEX_FILENAME and not e.name.endswith(".tmp")
+        )
+
+def build_image_index(image_dir):
+    index = empty_index()
+    filenames = list_images(image_dir)
+    for filename in filenames:
+        add_image(index, filename)
+    index["count"] = len(filenames)
+    return index
+
+def save_image_index(index, image_dir):
+    index["count"] = len(list_images(image_dir))
+
+    path = os.path.join(image_dir, INDEX_FILENAME)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(index, f)
+    os.replace(tmp_path, path)
+
+def load_image_index(image_dir, rebuild=False):
+    if not os.path.isdir(image_dir):
+        return empty_index()
+
+    path = os.path.join(image_dir, INDEX_FILENAME)
+    image_count = len(list_images(image_dir))
+
+    if not rebuild and os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            index = json.load(f)
+        # Rebuild if images were added or removed outside ingestion
+        if index.get("count") == image_count:
+            return index
+
+    index = build_image_index(image_dir)
+    save_image_index(index, image_dir)
+    return index
+
+def find_image(index, name=None, page_number=None):
+    key = normalize_name(name) if name else None
+    if key and key in index["names"]:
+        return index["names"][key]
+    if page_number is not None and str(page_number) in index["pages"]:
+        return index["pages"][str(page_number)]
+    return None
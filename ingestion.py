@@ -8,12 +8,20 @@ CMS PDF INGESTION PIPELINE
 # ---------------- IMPORTS ----------------
 import os
 import re
+import json
+import shutil
+import hashlib
+import threading
 import fitz  # PyMuPDF
 import pytesseract
 import pandas as pd
 from pdf2image import convert_from_path
-from pymongo import MongoClient, UpdateOne
+from concurrent.futures import ThreadPoolExecutor
+from pymongo import MongoClient, UpdateOne, DeleteOne
 from dotenv import load_dotenv
+from image_index import load_image_index, add_image, save_image_index
+from structured_parser import parse_structured_text
+from metrics import METRICS_ENABLED, span, count, summary
 
 # ---------------- LOAD ENV ----------------
 ENV_PATH = os.path.join(os.path.dirname(__file__), ".env")
@@ -30,10 +38,16 @@ PDF_FOLDER = "catalog_data/pdf_catalogs"
 TEXT_OUTPUT_FOLDER = "catalog_data/extracted_text"
 IMAGE_OUTPUT_FOLDER = "catalog_data/product_images"
 STRUCTURED_FOLDER = "catalog_data/structured_data"
+PRICES_FOLDER = os.path.join(STRUCTURED_FOLDER, "prices")  # one Parquet file per brand
+OCR_CACHE_FOLDER = "catalog_data/ocr_cache"
+IMAGE_BLOB_FOLDER = os.path.join(IMAGE_OUTPUT_FOLDER, "blobs")
 
 os.makedirs(TEXT_OUTPUT_FOLDER, exist_ok=True)
 os.makedirs(IMAGE_OUTPUT_FOLDER, exist_ok=True)
+os.makedirs(IMAGE_BLOB_FOLDER, exist_ok=True)
 os.makedirs(STRUCTURED_FOLDER, exist_ok=True)
+os.makedirs(PRICES_FOLDER, exist_ok=True)
+os.makedirs(OCR_CACHE_FOLDER, exist_ok=True)
 
 # OCR tools
 pytesseract.pytesseract.tesseract_cmd = os.getenv("TESSERACT_PATH")
@@ -42,6 +56,28 @@ POPPLER_PATH = os.getenv("POPPLER_PATH")
 if not pytesseract.pytesseract.tesseract_cmd or not POPPLER_PATH:
     raise RuntimeError("❌ TESSERACT_PATH or POPPLER_PATH missing in .env")
 
+# OCR parallelism: Tesseract runs as a subprocess, so threads scale across cores
+OCR_WORKERS = int(os.getenv("OCR_WORKERS", str(os.cpu_count() or 1)))
+OCR_MAX_PAGES_IN_MEMORY = int(os.getenv("OCR_MAX_PAGES_IN_MEMORY", "8"))
+
+# "hybrid" reads the PDF text layer first and only OCRs pages without usable text;
+# "ocr" rasterizes and OCRs every page
+EXTRACTION_MODE = os.getenv("EXTRACTION_MODE", "hybrid").lower()
+TEXT_LAYER_MIN_CHARS = int(os.getenv("TEXT_LAYER_MIN_CHARS", "50"))
+TEXT_LAYER_MIN_ALNUM_RATIO = float(os.getenv("TEXT_LAYER_MIN_ALNUM_RATIO", "0.5"))
+
+# OCR settings (part of the OCR cache key) and on-disk cache size limit
+OCR_LANG = "eng"
+OCR_DPI = 200
+OCR_CACHE_MAX_MB = int(os.getenv("OCR_CACHE_MAX_MB", "512"))
+
+# Image hashing/writing threads (PyMuPDF itself is not thread-safe, so
+# decoding stays on the calling thread)
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "4"))
+
+# Rows per unordered bulk_write when syncing structured data
+SYNC_BATCH_SIZE = int(os.getenv("SYNC_BATCH_SIZE", "1000"))
+
 # ---------------- MONGODB (REQUIRED) ----------------
 try:
     client = MongoClient(MONGO_URI, serverSelectionTimeoutMS=5000)
@@ -51,60 +87,297 @@ try:
 except Exception as e:
     raise RuntimeError(f"❌ MongoDB connection failed: {e}")
 
-# ---------------- STEP 1: OCR TEXT ----------------
-def extract_text_with_ocr(pdf_path, brand_name):
-    print(f"📄 OCR processing: {brand_name}")
+# ---------------- OCR CACHE ----------------
+# Per-page OCR results keyed by a hash of the rendered page image + OCR settings
+ocr_cache_stats = {"hits": 0, "misses": 0}
+ocr_cache_lock = threading.Lock()
+tesseract_version = None
+
+def ocr_cache_key(page_image):
+    global tesseract_version
+    if tesseract_version is None:
+        tesseract_version = str(pytesseract.get_tesseract_version())
+
+    h = hashlib.sha256()
+    h.update(f"{tesseract_version}|{OCR_LANG}|{OCR_DPI}|{page_image.mode}|{page_image.size}".encode("utf-8"))
+    h.update(page_image.tobytes())
+    return h.hexdigest()
+
+def ocr_cache_path(key):
+    return os.path.join(OCR_CACHE_FOLDER, key[:2], f"{key}.txt")
+
+def ocr_cache_get(key):
+    path = ocr_cache_path(key)
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            text = f.read()
+    except FileNotFoundError:
+        with ocr_cache_lock:
+            ocr_cache_stats["misses"] += 1
+        return None
+
+    os.utime(path)  # mark as recently used for eviction
+    with ocr_cache_lock:
+        ocr_cache_stats["hits"] += 1
+    return text
+
+def ocr_cache_put(key, text):
+    path = ocr_cache_path(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    tmp_path = f"{path}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+def evict_ocr_cache(max_mb=OCR_CACHE_MAX_MB):
+    entries = []
+    total = 0
+    for root, _, files in os.walk(OCR_CACHE_FOLDER):
+        for name in files:
+            path = os.path.join(root, name)
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+
+    limit = max_mb * 1024 * 1024
+    removed = 0
+    for _, size, path in sorted(entries):
+        if total <= limit:
+            break
+        os.remove(path)
+        total -= size
+        removed += 1
+
+    return removed
+
+# ---------------- STEP 1: TEXT EXTRACTION (TEXT LAYER + OCR) ----------------
+def is_usable_text_layer(text):
+    stripped = "".join(text.split())
+    if len(stripped) < TEXT_LAYER_MIN_CHARS:
+        return False
+
+    alnum = sum(ch.isalnum() for ch in stripped)
+    return alnum / len(stripped) >= TEXT_LAYER_MIN_ALNUM_RATIO
+
+# Group sorted 1-based page numbers into contiguous (first, last) runs
+def page_ranges(page_numbers, max_len):
+    first = last = None
+    for page_number in page_numbers:
+        if first is not None and page_number == last + 1 and page_number - first < max_len:
+            last = page_number
+            continue
+        if first is not None:
+            yield first, last
+        first = last = page_number
+    if first is not None:
+        yield first, last
+
+def ocr_image(page_image, brand_name):
+    key = ocr_cache_key(page_image)
+    text = ocr_cache_get(key)
+    count("ocr_cache", result="miss" if text is None else "hit")
+    if text is None:
+        with span("ocr_page", brand=brand_name):
+            text = pytesseract.image_to_string(page_image, lang=OCR_LANG)
+        ocr_cache_put(key, text)
+    return text
+
+def ocr_single_page(pdf_path, page_number, brand_name):
+    # Renders and OCRs one page (streaming ingestion, see pipeline.py)
+    pages = convert_from_path(
+        pdf_path,
+        dpi=OCR_DPI,
+        poppler_path=POPPLER_PATH,
+        first_page=page_number,
+        last_page=page_number
+    )
+    if not pages:
+        return ""
+
+    try:
+        return ocr_image(pages[0], brand_name)
+    finally:
+        pages[0].close()
+
+def extract_text_with_ocr(pdf_path, brand_name, workers=OCR_WORKERS,
+                          max_pages_in_memory=OCR_MAX_PAGES_IN_MEMORY,
+                          mode=EXTRACTION_MODE):
+    print(f"📄 Text extraction ({mode}): {brand_name}")
+
+    page_texts = []
+    page_methods = []
+
+    with fitz.open(pdf_path) as doc:
+        for page in doc:
+            text = page.get_text() if mode == "hybrid" else ""
+            if text and is_usable_text_layer(text):
+                page_texts.append(text)
+                page_methods.append("text_layer")
+            else:
+                page_texts.append("")
+                page_methods.append("ocr")
+            count("pages_extracted", method=page_methods[-1])
+
+    ocr_pages = [i + 1 for i, method in enumerate(page_methods) if method == "ocr"]
+
+    # Each rendered page holds a slot until its OCR finishes
+    slots = threading.BoundedSemaphore(max_pages_in_memory)
+    window = max(1, min(workers, max_pages_in_memory))
+
+    def ocr_page(page_number, page_image):
+        try:
+            page_texts[page_number - 1] = ocr_image(page_image, brand_name)
+        finally:
+            page_image.close()
+            slots.release()
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = []
+
+        for first_page, last_page in page_ranges(ocr_pages, window):
+            requested = last_page - first_page + 1
+
+            for _ in range(requested):
+                slots.acquire()
+
+            pages = convert_from_path(
+                pdf_path,
+                dpi=OCR_DPI,
+                poppler_path=POPPLER_PATH,
+                first_page=first_page,
+                last_page=last_page
+            )
+
+            for _ in range(requested - len(pages)):
+                slots.release()
+
+            for offset, page_image in enumerate(pages):
+                futures.append(pool.submit(ocr_page, first_page + offset, page_image))
+            del pages
 
-    pages = convert_from_path(pdf_path, poppler_path=POPPLER_PATH)
-    full_text = ""
+        for future in futures:
+            future.result()
 
-    for i, page_image in enumerate(pages):
-        text = pytesseract.image_to_string(page_image, lang="eng")
-        full_text += f"\n\n--- Page {i+1} ---\n{text}"
+    full_text = "".join(
+        f"\n\n--- Page {i+1} ---\n{text}" for i, text in enumerate(page_texts)
+    )
 
     text_path = os.path.join(TEXT_OUTPUT_FOLDER, f"{brand_name}.txt")
     with open(text_path, "w", encoding="utf-8") as f:
         f.write(full_text)
 
-    print(f"✅ OCR text saved → {text_path}")
+    # Per-page record of which extraction path was used
+    methods_path = os.path.join(TEXT_OUTPUT_FOLDER, f"{brand_name}.pages.json")
+    with open(methods_path, "w", encoding="utf-8") as f:
+        json.dump(
+            [{"page": i + 1, "method": method} for i, method in enumerate(page_methods)],
+            f,
+            indent=2
+        )
+
+    text_layer_pages = len(page_methods) - len(ocr_pages)
+    print(
+        f"✅ Text saved → {text_path} "
+        f"({text_layer_pages} text-layer pages, {len(ocr_pages)} OCR pages, {workers} workers)"
+    )
+    return page_methods
 
 # ---------------- STEP 2: SMART IMAGE EXTRACTION ----------------
-def extract_images_from_pdf(pdf_path, brand_name):
+# Images are stored once per content hash in blobs/; the named files
+# ("<sku>_1.png", "<brand>_page3_2.jpeg", ...) are hard links to the blob
+def store_image_blob(image_bytes, ext):
+    digest = hashlib.sha256(image_bytes).hexdigest()
+    blob_path = os.path.join(IMAGE_BLOB_FOLDER, f"{digest}.{ext}")
+
+    if os.path.exists(blob_path):
+        return blob_path, False
+
+    tmp_path = f"{blob_path}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(image_bytes)
+    os.replace(tmp_path, blob_path)
+    return blob_path, True
+
+def link_image(blob_path, image_path):
+    if os.path.exists(image_path):
+        if os.path.samefile(blob_path, image_path):
+            return
+        os.remove(image_path)
+
+    try:
+        os.link(blob_path, image_path)
+    except OSError:
+        shutil.copyfile(blob_path, image_path)
+
+def extract_images_from_pdf(pdf_path, brand_name, workers=IMAGE_WORKERS):
     print(f"🖼 Extracting images: {brand_name}")
     doc = fitz.open(pdf_path)
+    image_index = load_image_index(IMAGE_OUTPUT_FOLDER)
 
-    for page_index in range(len(doc)):
-        page = doc[page_index]
-        page_text = page.get_text("text").lower()
+    xref_blobs = {}  # xref -> (future of blob write, ext); each xref decoded once
+    targets = {}     # image filename -> xref; later pages win, as before
 
-        detected_name = None
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for page_index in range(len(doc)):
+            page = doc[page_index]
+            page_text = page.get_text("text").lower()
 
-        sku_match = re.search(r"\b\d{3,}\b", page_text)
-        if sku_match:
-            detected_name = sku_match.group()
+            detected_name = None
 
-        if not detected_name:
-            model_match = re.search(r"(model\s*[:\-]?\s*[a-z0-9\-]+)", page_text)
-            if model_match:
-                detected_name = model_match.group().replace("model", "").strip()
+            sku_match = re.search(r"\b\d{3,}\b", page_text)
+            if sku_match:
+                detected_name = sku_match.group()
 
-        if not detected_name:
-            detected_name = f"{brand_name}_page{page_index+1}"
+            if not detected_name:
+                model_match = re.search(r"(model\s*[:\-]?\s*[a-z0-9\-]+)", page_text)
+                if model_match:
+                    detected_name = model_match.group().replace("model", "").strip()
 
-        detected_name = re.sub(r"[^a-zA-Z0-9_\-]", "_", detected_name)
+            if not detected_name:
+                detected_name = f"{brand_name}_page{page_index+1}"
 
-        for img_index, img in enumerate(page.get_images(full=True)):
-            xref = img[0]
-            base = doc.extract_image(xref)
+            detected_name = re.sub(r"[^a-zA-Z0-9_\-]", "_", detected_name)
 
-            image_path = os.path.join(
-                IMAGE_OUTPUT_FOLDER,
-                f"{detected_name}_{img_index+1}.{base['ext']}"
-            )
-            with open(image_path, "wb") as f:
-                f.write(base["image"])
+            for img_index, img in enumerate(page.get_images(full=True)):
+                xref = img[0]
+                if xref not in xref_blobs:
+                    base = doc.extract_image(xref)
+                    xref_blobs[xref] = (
+                        pool.submit(store_image_blob, base["image"], base["ext"]),
+                        base["ext"]
+                    )
+
+                ext = xref_blobs[xref][1]
+                targets[f"{detected_name}_{img_index+1}.{ext}"] = xref
+
+        new_blobs = 0
+        blob_paths = {}
+        for xref, (future, _) in xref_blobs.items():
+            blob_paths[xref], created = future.result()
+            new_blobs += created
+
+        link_futures = [
+            pool.submit(link_image, blob_paths[xref], os.path.join(IMAGE_OUTPUT_FOLDER, image_filename))
+            for image_filename, xref in targets.items()
+        ]
+        for future in link_futures:
+            future.result()
+
+    doc.close()
 
-    print(f"✅ Images extracted for {brand_name}")
+    for image_filename in targets:
+        add_image(image_index, image_filename)
+    count("images_extracted", len(targets))
+    count("image_blobs_written", new_blobs)
+
+    # Keep the lookup index used by Embedding.enrich_metadata in sync
+    save_image_index(image_index, IMAGE_OUTPUT_FOLDER)
+
+    print(
+        f"✅ Images extracted for {brand_name} "
+        f"({len(targets)} images, {len(xref_blobs)} unique xrefs, {new_blobs} new blobs)"
+    )
 
 # ---------------- STEP 3: STRUCTURED DATA ----------------
 def extract_structured_data(brand_name):
@@ -113,96 +386,143 @@ def extract_structured_data(brand_name):
         return
 
     with open(txt_path, "r", encoding="utf-8") as f:
-        lines = f.read().split("\n")
-
-    products = []
-    current = {
-        "brand": brand_name,
-        "product_name": "",
-        "sku": "",
-        "price": "",
-        "specs": []
-    }
-
-    price_pattern = r"(₹\s?\d+[,\d]*\.?\d*|Rs\.?\s?\d+[,\d]*\.?\d*)"
-    sku_pattern = r"(SKU[:\s\-]*[A-Z0-9\-]+)"
-    model_pattern = r"(Model[:\s\-]*[A-Z0-9\-]+)"
-
-    for line in lines:
-        line = line.strip()
-        if not line:
-            continue
-
-        if re.search(sku_pattern, line, re.I):
-            current["sku"] = re.sub(r"SKU|:", "", line, flags=re.I).strip()
-
-        if re.search(model_pattern, line, re.I):
-            current["product_name"] = re.sub(r"Model|:", "", line, flags=re.I).strip()
-
-        price_match = re.search(price_pattern, line)
-        if price_match:
-            current["price"] = price_match.group()
-            current["specs"] = "; ".join(current["specs"])
-            products.append(current.copy())
-            current = {
-                "brand": brand_name,
-                "product_name": "",
-                "sku": "",
-                "price": "",
-                "specs": []
-            }
-            continue
+        text = f.read()
 
-        if any(k in line.lower() for k in ["watt", "volt", "mm", "kg", "capacity", "power"]):
-            current["specs"].append(line)
+    # Compiled, per-brand parser (structured_parser.py)
+    products = parse_structured_text(text, brand_name)
 
     if not products:
         return
 
-    csv_path = os.path.join(STRUCTURED_FOLDER, "price_list.csv")
-    new_df = pd.DataFrame(products)
-
-    if os.path.exists(csv_path):
-        old = pd.read_csv(csv_path)
-        old = old[old["brand"] != brand_name]
-        pd.concat([old, new_df]).to_csv(csv_path, index=False)
-    else:
-        new_df.to_csv(csv_path, index=False)
+    save_brand_prices(brand_name, pd.DataFrame(products))
 
     print(f"✅ Structured data saved for {brand_name}")
 
-# ---------------- STEP 4: MONGODB UPSERT ----------------
-def sync_csv_to_mongodb(csv_name, collection, keys):
-    path = os.path.join(STRUCTURED_FOLDER, csv_name)
-    if not os.path.exists(path):
-        return
+# Row identity (which product) and content hash (did it change) for diffed syncs
+PRICE_KEY_FIELDS = ["brand", "sku", "product_name"]
+PRICE_CONTENT_FIELDS = ["brand", "product_name", "sku", "price", "specs", "sku_key", "model_key"]
 
-    df = pd.read_csv(path)
-    if df.empty:
+def row_digest(row, fields):
+    values = [None if pd.isna(row.get(f)) else str(row.get(f)) for f in fields]
+    return hashlib.sha1(json.dumps(values).encode("utf-8")).hexdigest()
+
+def brand_prices_path(brand_name):
+    return os.path.join(PRICES_FOLDER, f"{brand_name}.parquet")
+
+def save_brand_prices(brand_name, df):
+    df = df.copy()
+    df["row_key"] = df.apply(lambda r: row_digest(r, PRICE_KEY_FIELDS), axis=1)
+    df["row_hash"] = df.apply(lambda r: row_digest(r, PRICE_CONTENT_FIELDS), axis=1)
+    # Same product listed twice in a catalog: the later listing wins
+    df = df.drop_duplicates(subset=["row_key"], keep="last")
+    df.to_parquet(brand_prices_path(brand_name), index=False)
+
+def migrate_price_list_csv():
+    # One-off split of the legacy combined price_list.csv into per-brand files
+    csv_path = os.path.join(STRUCTURED_FOLDER, "price_list.csv")
+    if not os.path.exists(csv_path) or os.listdir(PRICES_FOLDER):
         return
 
+    df = pd.read_csv(csv_path, dtype={"sku_key": str, "model_key": str})
+    for brand_name, brand_df in df.groupby("brand"):
+        save_brand_prices(brand_name, brand_df.drop(columns=["row_key", "row_hash"], errors="ignore"))
+
+    print(f"✅ Migrated {csv_path} → {PRICES_FOLDER}")
+
+# ---------------- STEP 4: MONGODB UPSERT ----------------
+def sync_prices_to_mongodb(collection, batch_size=SYNC_BATCH_SIZE, brand_names=None):
+    inserted = changed = deleted = unchanged = 0
     ops = []
-    for row in df.to_dict("records"):
-        query = {k: row.get(k) for k in keys}
-        ops.append(UpdateOne(query, {"$set": row}, upsert=True))
 
-    collection.bulk_write(ops)
-    print(f"🗄 MongoDB synced → {csv_name}")
+    def flush():
+        if ops:
+            with span("bulk_write", collection="prices"):
+                collection.bulk_write(ops, ordered=False)
+            count("rows_written", len(ops), collection="prices")
+            ops.clear()
+
+    for file in sorted(os.listdir(PRICES_FOLDER)):
+        if not file.endswith(".parquet"):
+            continue
+        if brand_names is not None and os.path.splitext(file)[0] not in brand_names:
+            continue
+
+        df = pd.read_parquet(os.path.join(PRICES_FOLDER, file))
+        if df.empty:
+            continue
+        brand_name = os.path.splitext(file)[0]
+
+        existing = {}
+        for doc in collection.find({"brand": brand_name}, {"_id": 1, "row_key": 1, "row_hash": 1}):
+            key = doc.get("row_key")
+            if key is None:
+                # Synced before row keys existed: replace with keyed rows
+                ops.append(DeleteOne({"_id": doc["_id"]}))
+                deleted += 1
+            else:
+                existing[key] = doc.get("row_hash")
+
+        for row in df.to_dict("records"):
+            row = {k: (None if pd.isna(v) else v) for k, v in row.items()}
+            key = row["row_key"]
+
+            if key not in existing:
+                inserted += 1
+            elif existing.pop(key) != row["row_hash"]:
+                changed += 1
+            else:
+                unchanged += 1
+                continue
+
+            ops.append(UpdateOne({"row_key": key}, {"$set": row}, upsert=True))
+            if len(ops) >= batch_size:
+                flush()
+
+        # Rows no longer present in the brand's catalog
+        for key in existing:
+            ops.append(DeleteOne({"row_key": key}))
+            deleted += 1
+            if len(ops) >= batch_size:
+                flush()
+
+    flush()
+    print(
+        f"🗄 MongoDB synced → prices "
+        f"({inserted} inserted, {changed} changed, {deleted} deleted, {unchanged} unchanged)"
+    )
 
 # ---------------- MAIN PIPELINE ----------------
 def process_all_pdfs():
+    migrate_price_list_csv()
+
     for file in os.listdir(PDF_FOLDER):
         if file.lower().endswith(".pdf"):
             pdf_path = os.path.join(PDF_FOLDER, file)
             brand = os.path.splitext(file)[0]
 
             print(f"\n🚀 Processing catalog: {brand}")
-            extract_text_with_ocr(pdf_path, brand)
-            extract_images_from_pdf(pdf_path, brand)
-            extract_structured_data(brand)
+            with span("extract_text", brand=brand):
+                extract_text_with_ocr(pdf_path, brand)
+            with span("extract_images", brand=brand):
+                extract_images_from_pdf(pdf_path, brand)
+            with span("parse_structured", brand=brand):
+                extract_structured_data(brand)
 
     # MongoDB sync (MANDATORY)
-    sync_csv_to_mongodb("price_list.csv", db.prices, ["sku"])
+    db.prices.create_index("row_key")
+    db.prices.create_index("brand")
+    sync_prices_to_mongodb(db.prices)
+    db.prices.create_index("sku_key")
+    db.prices.create_index("model_key")
+
+    evicted = evict_ocr_cache()
+    print(
+        f"🗃 OCR cache: {ocr_cache_stats['hits']} hits, "
+        f"{ocr_cache_stats['misses']} misses, {evicted} entries evicted"
+    )
+
+    if METRICS_ENABLED:
+        print(f"⏱ Stage timings:\n{summary()}")
 
 # ---------------- RUN ----------------
 if __name__ == "__main__":
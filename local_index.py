@@ -0,0 +1,295 @@
+"""
+Local in-process vector index for the Embeddings collection.
+
+Exports the MongoDB collection into a memory-mapped float32 matrix
+(vectors.npy) plus a JSON-lines metadata sidecar (meta.jsonl), and serves
+exact top-k search with NumPy. For large corpora one of two approximate
+first passes can be built: an IVF index (k-means coarse quantizer) that
+limits each search to a few clusters, or int8 / binary codes (see
+quantization.py) whose candidates are rescored against the float32 vectors.
+Binary codes are used by default once built: a popcount over 1/32 of the
+bytes is cheaper than exact float search. int8 codes are scored as float32
+blocks, which costs more than exact search with BLAS, so they are only used
+with quantized=True (they save memory, not time).
+
+Usage:
+    python local_index.py            # export + build IVF index
+    python local_index.py --no-ivf   # export only (exact search)
+    python local_index.py --codes binary   # export + first-pass codes (no IVF)
+    python local_index.py --codes int8     # int8 codes, used with quantized=True
+"""
+
+import os
+import json
+import threading
+import numpy as np
+from quantization import rescore_factor, quantize_int8, quantize_binary, hamming_similarity, stored_vector
+
+LOCAL_INDEX_DIR = os.getenv("LOCAL_INDEX_DIR", "catalog_data/local_index")
+IVF_NPROBE = int(os.getenv("IVF_NPROBE", "8"))
+
+# -------------------------------------------------
+# Export
+# -------------------------------------------------
+def export_collection(collection, index_dir=LOCAL_INDEX_DIR, batch_size=1000):
+    os.makedirs(index_dir, exist_ok=True)
+
+    total = collection.count_documents({})
+    first = collection.find_one({}, {"embedding": 1, "embedding_f32": 1})
+    if not total or not first:
+        raise ValueError("Embeddings collection is empty, nothing to export")
+
+    dim = len(stored_vector(first))
+    vectors_tmp = os.path.join(index_dir, "vectors.npy.tmp")
+    meta_tmp = os.path.join(index_dir, "meta.jsonl.tmp")
+
+    matrix = np.lib.format.open_memmap(vectors_tmp, mode="w+", dtype=np.float32, shape=(total, dim))
+    offsets = []
+
+    cursor = collection.find(
+        {},
+        {"_id": 0, "chunk_id": 1, "text": 1, "embedding": 1, "embedding_f32": 1, "metadata": 1, "ingested_at": 1},
+        batch_size=batch_size
+    )
+
+    rows = 0
+    with open(meta_tmp, "wb") as meta_file:
+        for doc in cursor:
+            if rows == total:
+                break  # documents inserted while exporting are picked up next time
+
+            vector = stored_vector(doc)  # float or compact (int8 / binary) storage
+            norm = np.linalg.norm(vector)
+            matrix[rows] = vector / norm if norm else vector
+
+            offsets.append(meta_file.tell())
+            metadata = doc.get("metadata", {})
+            metadata.pop("source_text", None)  # legacy chunks carried the whole document
+            record = {
+                "chunk_id": doc.get("chunk_id"),
+                "text": doc.get("text", ""),
+                "metadata": metadata,
+                "ingested_at": doc.get("ingested_at")
+            }
+            meta_file.write(json.dumps(record, default=str).encode("utf-8") + b"\n")
+            rows += 1
+
+    matrix.flush()
+    del matrix
+
+    if rows < total:
+        # Documents were deleted while exporting; shrink to what was read
+        full = np.load(vectors_tmp, mmap_mode="r")
+        np.save(vectors_tmp + ".trim.npy", np.asarray(full[:rows]))
+        del full
+        os.replace(vectors_tmp + ".trim.npy", vectors_tmp)
+
+    os.replace(vectors_tmp, os.path.join(index_dir, "vectors.npy"))
+    os.replace(meta_tmp, os.path.join(index_dir, "meta.jsonl"))
+    np.save(os.path.join(index_dir, "meta_offsets.npy"), np.asarray(offsets, dtype=np.int64))
+
+    # A stale IVF index or code file would point at the wrong rows
+    for name in ("ivf_centroids.npy", "ivf_order.npy", "ivf_offsets.npy", "codes_int8.npy", "codes_binary.npy"):
+        path = os.path.join(index_dir, name)
+        if os.path.exists(path):
+            os.remove(path)
+
+    print(f"Exported {rows} vectors ({dim} dims) → {index_dir}")
+    return rows
+
+# -------------------------------------------------
+# Approximate index (IVF)
+# -------------------------------------------------
+def build_ivf(index_dir=LOCAL_INDEX_DIR, nlist=None, iterations=10, sample_size=50000, seed=0):
+    matrix = np.load(os.path.join(index_dir, "vectors.npy"), mmap_mode="r")
+    n = matrix.shape[0]
+    nlist = nlist or max(1, int(np.sqrt(n)))
+
+    rng = np.random.default_rng(seed)
+    sample = np.asarray(matrix[rng.choice(n, size=min(n, sample_size), replace=False)])
+    centroids = sample[rng.choice(len(sample), size=min(nlist, len(sample)), replace=False)].copy()
+
+    # Spherical k-means on a sample: vectors are unit length, so assign by dot product
+    for _ in range(iterations):
+        labels = np.argmax(sample @ centroids.T, axis=1)
+        for c in range(len(centroids)):
+            members = sample[labels == c]
+            if len(members):
+                centroid = members.mean(axis=0)
+                norm = np.linalg.norm(centroid)
+                centroids[c] = centroid / norm if norm else centroid
+
+    labels = np.empty(n, dtype=np.int32)
+    for start in range(0, n, 10000):
+        labels[start:start + 10000] = np.argmax(np.asarray(matrix[start:start + 10000]) @ centroids.T, axis=1)
+
+    order = np.argsort(labels, kind="stable").astype(np.int64)
+    list_offsets = np.searchsorted(labels[order], np.arange(len(centroids) + 1)).astype(np.int64)
+
+    np.save(os.path.join(index_dir, "ivf_centroids.npy"), centroids.astype(np.float32))
+    np.save(os.path.join(index_dir, "ivf_order.npy"), order)
+    np.save(os.path.join(index_dir, "ivf_offsets.npy"), list_offsets)
+
+    print(f"Built IVF index with {len(centroids)} lists over {n} vectors")
+
+# -------------------------------------------------
+# Quantized first-pass codes
+# -------------------------------------------------
+def build_codes(index_dir=LOCAL_INDEX_DIR, kind="int8", batch_size=10000):
+    matrix = np.load(os.path.join(index_dir, "vectors.npy"), mmap_mode="r")
+    quantize = quantize_int8 if kind == "int8" else quantize_binary
+
+    first = quantize(matrix[:1])
+    path = os.path.join(index_dir, f"codes_{kind}.npy")
+    codes = np.lib.format.open_memmap(path + ".tmp", mode="w+", dtype=first.dtype,
+                                      shape=(matrix.shape[0], first.shape[1]))
+    for start in range(0, matrix.shape[0], batch_size):
+        codes[start:start + batch_size] = quantize(np.asarray(matrix[start:start + batch_size]))
+    codes.flush()
+    del codes
+    os.replace(path + ".tmp", path)
+
+    # Only one kind of codes is used at a time
+    other = os.path.join(index_dir, f"codes_{'binary' if kind == 'int8' else 'int8'}.npy")
+    if os.path.exists(other):
+        os.remove(other)
+
+    print(f"Built {kind} codes for {matrix.shape[0]} vectors")
+
+def code_norms(codes, batch_size=65536):
+    norms = np.empty(codes.shape[0], dtype=np.float32)
+    for start in range(0, codes.shape[0], batch_size):
+        norms[start:start + batch_size] = np.linalg.norm(
+            np.asarray(codes[start:start + batch_size], dtype=np.float32), axis=1
+        )
+    norms[norms == 0] = 1
+    return norms
+
+def code_scores(codes, kind, query, norms=None, batch_size=65536):
+    if kind == "binary":
+        return hamming_similarity(codes, quantize_binary(query))
+
+    # Each vector has its own int8 scale, so compare by cosine of the codes.
+    # Blocks are widened to float32 for BLAS without materializing the whole matrix.
+    if norms is None:
+        norms = code_norms(codes, batch_size)
+    query_code = quantize_int8(query)[0].astype(np.float32)
+    scores = np.empty(codes.shape[0], dtype=np.float32)
+    for start in range(0, codes.shape[0], batch_size):
+        block = np.asarray(codes[start:start + batch_size], dtype=np.float32)
+        scores[start:start + batch_size] = block @ query_code
+    return scores / norms
+
+# -------------------------------------------------
+# Load + search
+# -------------------------------------------------
+def load_local_index(index_dir=LOCAL_INDEX_DIR):
+    vectors_path = os.path.join(index_dir, "vectors.npy")
+    if not os.path.exists(vectors_path):
+        raise FileNotFoundError(f"No local index at {index_dir}; run `python local_index.py` first")
+
+    index = {
+        "matrix": np.load(vectors_path, mmap_mode="r"),
+        "offsets": np.load(os.path.join(index_dir, "meta_offsets.npy")),
+        "meta_file": open(os.path.join(index_dir, "meta.jsonl"), "rb"),
+        "meta_lock": threading.Lock(),
+        "ivf": None,
+        "codes": None
+    }
+
+    for kind in ("int8", "binary"):
+        codes_path = os.path.join(index_dir, f"codes_{kind}.npy")
+        if os.path.exists(codes_path):
+            codes = np.load(codes_path, mmap_mode="r")
+            index["codes"] = {
+                "kind": kind,
+                "matrix": codes,
+                "norms": code_norms(codes) if kind == "int8" else None
+            }
+
+    centroids_path = os.path.join(index_dir, "ivf_centroids.npy")
+    if os.path.exists(centroids_path):
+        index["ivf"] = {
+            "centroids": np.load(centroids_path),
+            "order": np.load(os.path.join(index_dir, "ivf_order.npy"), mmap_mode="r"),
+            "offsets": np.load(os.path.join(index_dir, "ivf_offsets.npy"))
+        }
+
+    return index
+
+def read_record(index, row):
+    with index["meta_lock"]:
+        index["meta_file"].seek(int(index["offsets"][row]))
+        line = index["meta_file"].readline()
+    return json.loads(line)
+
+def top_k(scores, k):
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    best = np.argpartition(-scores, k - 1)[:k]
+    return best[np.argsort(-scores[best])]
+
+def search(index, query_vector, k=5, approximate=None, nprobe=IVF_NPROBE, quantized=None):
+    query = np.asarray(query_vector, dtype=np.float32)
+    norm = np.linalg.norm(query)
+    if norm:
+        query = query / norm
+
+    # Binary codes take precedence over IVF; approximate=False / quantized=False force
+    # exact search, quantized=True also uses int8 codes
+    ivf, codes = index["ivf"], index["codes"]
+    if quantized is None:
+        quantized = codes is not None and codes["kind"] == "binary" and approximate is not False
+    if approximate is None:
+        approximate = ivf is not None
+
+    if quantized and codes is not None:
+        # First pass over the compact codes, exact float32 rescoring of the candidates
+        candidates = top_k(
+            code_scores(codes["matrix"], codes["kind"], query, codes["norms"]),
+            k * rescore_factor(codes["kind"])
+        )
+        rows = np.sort(candidates)
+        scores = np.asarray(index["matrix"][rows]) @ query
+    elif approximate and ivf is not None:
+        probes = top_k(ivf["centroids"] @ query, nprobe)
+        rows = np.sort(np.concatenate([
+            np.asarray(ivf["order"][ivf["offsets"][p]:ivf["offsets"][p + 1]]) for p in probes
+        ]))
+        scores = np.asarray(index["matrix"][rows]) @ query
+    else:
+        rows = None
+        scores = index["matrix"] @ query
+
+    results = []
+    for i in top_k(scores, k):
+        row = int(rows[i]) if rows is not None else int(i)
+        record = read_record(index, row)
+        # Same scale as Atlas cosine vectorSearchScore: (1 + cosine) / 2
+        record["score"] = float((1 + scores[i]) / 2)
+        results.append(record)
+
+    return results
+
+# -------------------------------------------------
+# MAIN
+# -------------------------------------------------
+if __name__ == "__main__":
+    import sys
+    from dotenv import load_dotenv
+    from pymongo import MongoClient
+
+    load_dotenv()
+    MONGODB_URI = os.getenv("MONGODB_URI")
+    if not MONGODB_URI:
+        raise EnvironmentError("MONGODB_URI not found in .env file")
+
+    client = MongoClient(MONGODB_URI)
+    export_collection(client["catalog_db"]["Embeddings"])
+
+    # Codes replace the IVF index as the approximate first pass
+    if "--codes" in sys.argv:
+        build_codes(kind=sys.argv[sys.argv.index("--codes") + 1])
+    elif "--no-ivf" not in sys.argv:
+        build_ivf()
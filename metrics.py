@@ -0,0 +1,234 @@
+"""
+Lightweight tracing and metrics for ingestion, retrieval and generation.
+
+With METRICS_ENABLED=true, span() times a stage and count() bumps a counter.
+Spans feed one latency histogram labelled by stage, and finished spans can
+be written as JSON lines to METRICS_LOG. prometheus_text() renders
+everything in the Prometheus text format, served on /metrics by
+start_metrics_server() (METRICS_PORT).
+
+When disabled, span() returns a shared no-op context manager and count()
+returns immediately, so instrumented code pays one flag check per call.
+"""
+
+import os
+import json
+import time
+import threading
+from dotenv import load_dotenv
+
+load_dotenv()
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "false").lower() == "true"
+METRICS_LOG = os.getenv("METRICS_LOG")  # JSON-lines file for finished spans
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # 0 = no HTTP endpoint
+
+METRIC_PREFIX = "catalog_"
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+lock = threading.Lock()
+counters = {}    # (name, labels) -> value
+histograms = {}  # (name, labels) -> {"buckets": [...], "sum": float, "count": int}
+server = None
+
+def label_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+# -------------------------------------------------
+# Counters + histograms
+# -------------------------------------------------
+def count(name, value=1, **labels):
+    if not METRICS_ENABLED:
+        return
+
+    key = (name, label_key(labels))
+    with lock:
+        counters[key] = counters.get(key, 0) + value
+
+def observe(name, seconds, **labels):
+    if not METRICS_ENABLED:
+        return
+
+    key = (name, label_key(labels))
+    with lock:
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = {"buckets": [0] * len(BUCKETS), "sum": 0.0, "count": 0}
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                histogram["buckets"][i] += 1
+        histogram["sum"] += seconds
+        histogram["count"] += 1
+
+def count_tokens(usage, prompt_estimate, completion_estimate, **labels):
+    # Provider-reported usage when the LLM returns it, otherwise the estimates
+    usage = usage or {}
+    count("llm_tokens", usage.get("input_tokens", prompt_estimate), kind="prompt", **labels)
+    count("llm_tokens", usage.get("output_tokens", completion_estimate), kind="completion", **labels)
+
+def reset():
+    with lock:
+        counters.clear()
+        histograms.clear()
+
+# -------------------------------------------------
+# Spans
+# -------------------------------------------------
+log_lock = threading.Lock()
+
+def write_log(record):
+    line = json.dumps(record, default=str)
+    with log_lock:
+        with open(METRICS_LOG, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+
+class Span:
+    __slots__ = ("name", "labels", "fields", "start")
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+        self.fields = {}
+
+    def set(self, **fields):
+        # Extra values for the JSON log line only (sizes, token counts, ...)
+        self.fields.update(fields)
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        seconds = time.perf_counter() - self.start
+        if exc_type is None:
+            status = "ok"
+        elif issubclass(exc_type, GeneratorExit):
+            status = "cancelled"  # streaming consumer stopped early
+        else:
+            status = "error"
+
+        observe("stage_duration_seconds", seconds, stage=self.name, **self.labels)
+        if status == "error":
+            count("stage_errors", stage=self.name, **self.labels)
+
+        if METRICS_LOG:
+            write_log({
+                "ts": time.time(),
+                "span": self.name,
+                "duration_ms": round(seconds * 1000, 3),
+                "status": status,
+                **self.labels,
+                **self.fields
+            })
+        return False
+
+class NoopSpan:
+    __slots__ = ()
+
+    def set(self, **fields):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+NOOP_SPAN = NoopSpan()
+
+def span(name, **labels):
+    if not METRICS_ENABLED:
+        return NOOP_SPAN
+    return Span(name, labels)
+
+# -------------------------------------------------
+# Export
+# -------------------------------------------------
+def format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+def prometheus_text():
+    with lock:
+        counter_items = sorted(counters.items())
+        histogram_items = sorted((key, dict(h, buckets=list(h["buckets"]))) for key, h in histograms.items())
+
+    lines = []
+    typed = set()
+    for (name, labels), value in counter_items:
+        metric = f"{METRIC_PREFIX}{name}_total"
+        if metric not in typed:
+            lines.append(f"# TYPE {metric} counter")
+            typed.add(metric)
+        lines.append(f"{metric}{format_labels(labels)} {value}")
+
+    for (name, labels), h in histogram_items:
+        metric = f"{METRIC_PREFIX}{name}"
+        if metric not in typed:
+            lines.append(f"# TYPE {metric} histogram")
+            typed.add(metric)
+        for bound, value in zip(BUCKETS, h["buckets"]):
+            lines.append(f"{metric}_bucket{format_labels(labels, [('le', bound)])} {value}")
+        lines.append(f"{metric}_bucket{format_labels(labels, [('le', '+Inf')])} {h['count']}")
+        lines.append(f"{metric}_sum{format_labels(labels)} {h['sum']:.6f}")
+        lines.append(f"{metric}_count{format_labels(labels)} {h['count']}")
+
+    return "\n".join(lines) + "\n"
+
+def snapshot():
+    with lock:
+        return {
+            "counters": [
+                {"name": name, "labels": dict(labels), "value": value}
+                for (name, labels), value in sorted(counters.items())
+            ],
+            "histograms": [
+                {"name": name, "labels": dict(labels), "count": h["count"], "sum": h["sum"],
+                 "buckets": dict(zip(map(str, BUCKETS), h["buckets"]))}
+                for (name, labels), h in sorted(histograms.items())
+            ]
+        }
+
+def summary():
+    # One line per stage: calls, total and mean seconds
+    lines = []
+    for h in snapshot()["histograms"]:
+        if h["name"] != "stage_duration_seconds" or not h["count"]:
+            continue
+        labels = ", ".join(f"{k}={v}" for k, v in h["labels"].items() if k != "stage")
+        stage = h["labels"]["stage"] + (f" ({labels})" if labels else "")
+        lines.append(f"  {stage}: {h['count']} calls, {h['sum']:.2f}s total, {h['sum'] / h['count'] * 1000:.1f} ms avg")
+    return "\n".join(lines)
+
+def start_metrics_server(port=METRICS_PORT):
+    # /metrics (Prometheus text) and /metrics.json on a daemon thread
+    global server
+    if not METRICS_ENABLED or not port or server is not None:
+        return server
+
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == "/metrics":
+                body, content_type = prometheus_text().encode("utf-8"), "text/plain; version=0.0.4"
+            elif self.path == "/metrics.json":
+                body, content_type = json.dumps(snapshot()).encode("utf-8"), "application/json"
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("0.0.0.0", port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"[metrics] serving http://0.0.0.0:{port}/metrics")
+    return server
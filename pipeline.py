@@ -0,0 +1,415 @@
+"""
+Streaming ingestion: extract -> parse -> chunk -> embed -> upsert.
+
+Each stage runs on its own thread and hands work to the next through a
+bounded queue, so a catalog's first pages are chunked, embedded and
+searchable while later pages are still being OCR'd. Memory is bounded by
+the queue sizes and the OCR window, not by the number or size of catalogs.
+
+Produces the same outputs as `python ingestion.py` followed by
+`python Embedding.py`: extracted text and pages.json, product images,
+per-brand prices synced to db.prices and incrementally synced chunks with
+the same chunk ids, so both paths can be used on the same collection.
+
+Usage:
+    python pipeline.py          # only new chunks are embedded
+    python pipeline.py --full   # re-embed every chunk
+"""
+
+import os
+import sys
+import json
+import time
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import fitz  # PyMuPDF
+import pandas as pd
+import ingestion
+import Embedding
+from image_index import load_image_index
+from structured_parser import structured_stream
+from resources import get_collection, get_embedding_model
+from metrics import METRICS_ENABLED, span, count, summary
+
+# Items waiting between two stages
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", "32"))
+# Seconds the embed stage waits for more chunks before embedding a partial batch
+PIPELINE_FLUSH_SECONDS = float(os.getenv("PIPELINE_FLUSH_SECONDS", "1.0"))
+
+CHUNK_SIZE = 1000
+CHUNK_OVERLAP = 100
+# Catalog text buffered before splitting; the last (still growing) chunk is carried over
+CHUNK_BUFFER_CHARS = 8 * CHUNK_SIZE
+
+class PipelineStopped(Exception):
+    pass
+
+# -------------------------------------------------
+# Queue helpers (give up once another stage has failed)
+# -------------------------------------------------
+def put(pipe, q, item):
+    while not pipe["stop"].is_set():
+        try:
+            q.put(item, timeout=0.2)
+            return
+        except queue.Full:
+            continue
+    raise PipelineStopped()
+
+def get(pipe, q, timeout=None):
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while not pipe["stop"].is_set():
+        wait = 0.2 if deadline is None else min(0.2, deadline - time.monotonic())
+        if wait <= 0:
+            raise queue.Empty
+        try:
+            return q.get(timeout=wait)
+        except queue.Empty:
+            continue
+    raise PipelineStopped()
+
+# -------------------------------------------------
+# Stage 1: extract (text layer, OCR fallback per page, images)
+# -------------------------------------------------
+def extract_stage(pipe, pdf_paths, out_q, workers=ingestion.OCR_WORKERS,
+                  max_pages_in_memory=ingestion.OCR_MAX_PAGES_IN_MEMORY,
+                  mode=ingestion.EXTRACTION_MODE):
+    # Each OCR worker holds one rendered page; pages leave the stage in order
+    workers = max(1, min(workers, max_pages_in_memory))
+    window = 2 * workers
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for pdf_path in pdf_paths:
+            brand = os.path.splitext(os.path.basename(pdf_path))[0]
+            print(f"\n🚀 Processing catalog: {brand}")
+
+            # Images first: chunk metadata links images by SKU / page
+            with span("extract_images", brand=brand):
+                ingestion.extract_images_from_pdf(pdf_path, brand)
+            put(pipe, out_q, {"kind": "start", "brand": brand})
+
+            text_path = os.path.join(ingestion.TEXT_OUTPUT_FOLDER, f"{brand}.txt")
+            page_methods = []
+            pending = deque()
+
+            with open(text_path + ".tmp", "w", encoding="utf-8") as text_file:
+                def emit():
+                    page_number, result = pending.popleft()
+                    text = result if isinstance(result, str) else result.result()
+                    page_text = f"\n\n--- Page {page_number} ---\n{text}"
+                    text_file.write(page_text)
+                    put(pipe, out_q, {"kind": "page", "brand": brand, "page": page_number, "text": page_text})
+
+                with fitz.open(pdf_path) as doc:
+                    for page_index, page in enumerate(doc):
+                        page_number = page_index + 1
+                        text = page.get_text() if mode == "hybrid" else ""
+                        if text and ingestion.is_usable_text_layer(text):
+                            pending.append((page_number, text))
+                            page_methods.append("text_layer")
+                        else:
+                            pending.append((page_number, pool.submit(
+                                ingestion.ocr_single_page, pdf_path, page_number, brand
+                            )))
+                            page_methods.append("ocr")
+                        count("pages_extracted", method=page_methods[-1])
+
+                        while len(pending) >= window:
+                            emit()
+
+                while pending:
+                    emit()
+
+            os.replace(text_path + ".tmp", text_path)
+            with open(os.path.join(ingestion.TEXT_OUTPUT_FOLDER, f"{brand}.pages.json"), "w", encoding="utf-8") as f:
+                json.dump(
+                    [{"page": i + 1, "method": method} for i, method in enumerate(page_methods)],
+                    f,
+                    indent=2
+                )
+
+            ocr_pages = page_methods.count("ocr")
+            print(
+                f"✅ Text extracted for {brand} "
+                f"({len(page_methods) - ocr_pages} text-layer pages, {ocr_pages} OCR pages)"
+            )
+            put(pipe, out_q, {"kind": "end", "brand": brand, "pages": len(page_methods)})
+
+    put(pipe, out_q, None)
+
+# -------------------------------------------------
+# Stage 2: structured data (db.prices, synced per catalog)
+# -------------------------------------------------
+def parse_stage(pipe, in_q, out_q):
+    feed = None
+    products = []
+
+    while True:
+        item = get(pipe, in_q)
+        if item is None:
+            break
+
+        if item["kind"] == "start":
+            feed = structured_stream(item["brand"])
+            products = []
+        elif item["kind"] == "page":
+            products.extend(feed(item["text"]))
+        elif products:
+            brand = item["brand"]
+            ingestion.save_brand_prices(brand, pd.DataFrame(products))
+            ingestion.sync_prices_to_mongodb(ingestion.db.prices, brand_names={brand})
+            products = []
+
+        put(pipe, out_q, item)
+
+    put(pipe, out_q, None)
+
+# -------------------------------------------------
+# Stage 3: chunk (same chunks and ids as Embedding.split_documents)
+# -------------------------------------------------
+def emit_chunks(pipe, out_q, splitter, state, final):
+    with span("chunking"):
+        chunks = splitter.create_documents([state["buffer"]], metadatas=[{"source": state["source"]}])
+
+        # The last chunk can still grow, so it is re-split with the next pages.
+        # Greedy splitting restarted at a chunk's start reproduces that chunk.
+        ready = chunks if final else chunks[:-1]
+        for chunk in ready:
+            start = state["offset"] + chunk.metadata.pop("start_index", 0)
+            Embedding.finalize_chunk(chunk, state["markers"], start, state["image_index"])
+
+        if final:
+            state["buffer"] = ""
+        elif chunks:
+            cut = chunks[-1].metadata["start_index"]
+            state["buffer"] = state["buffer"][cut:]
+            state["offset"] += cut
+
+    count("chunks_created", len(ready))
+    for chunk in ready:
+        put(pipe, out_q, {"kind": "chunk", "chunk": chunk})
+
+def chunk_stage(pipe, in_q, out_q, chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP,
+                buffer_chars=CHUNK_BUFFER_CHARS):
+    splitter = Embedding.make_splitter(chunk_size, chunk_overlap)
+    state = None
+
+    while True:
+        item = get(pipe, in_q)
+        if item is None:
+            break
+
+        if item["kind"] == "start":
+            # Same source string Embedding.load_documents reports for this catalog
+            source = Embedding.text_source(item["brand"], ingestion.TEXT_OUTPUT_FOLDER)
+            state = {
+                "source": source,
+                "buffer": "",
+                "offset": 0,   # document offset of buffer[0]
+                "length": 0,   # document length so far
+                "markers": ([], []),
+                "image_index": load_image_index(ingestion.IMAGE_OUTPUT_FOLDER)
+            }
+            put(pipe, out_q, {**item, "source": source})
+
+        elif item["kind"] == "page":
+            offsets, pages = state["markers"]
+            for match in Embedding.page_marker_pattern.finditer(item["text"]):
+                offsets.append(state["length"] + match.start())
+                pages.append(match.group(1))
+
+            state["buffer"] += item["text"]
+            state["length"] += len(item["text"])
+            if len(state["buffer"]) >= buffer_chars:
+                emit_chunks(pipe, out_q, splitter, state, final=False)
+
+        else:
+            emit_chunks(pipe, out_q, splitter, state, final=True)
+            put(pipe, out_q, {**item, "source": state["source"]})
+            state = None
+
+    put(pipe, out_q, None)
+
+# -------------------------------------------------
+# Stage 4: embed (new chunks only unless full)
+# -------------------------------------------------
+def embed_stage(pipe, in_q, out_q, full=False, batch_size=Embedding.EMBED_BATCH_SIZE,
+                flush_seconds=PIPELINE_FLUSH_SECONDS):
+    embedding_model = get_embedding_model()
+    collection = get_collection()
+    batch = []
+    stored, seen, moved = {}, set(), []
+
+    def flush():
+        if batch:
+            vectors = Embedding.embed_chunks(embedding_model, batch, batch_size)
+            put(pipe, out_q, {"kind": "vectors", "chunks": list(batch), "vectors": vectors})
+            batch.clear()
+
+    while True:
+        try:
+            # A partial batch is embedded once the upstream stages go quiet
+            item = get(pipe, in_q, timeout=flush_seconds if batch else None)
+        except queue.Empty:
+            flush()
+            continue
+        if item is None:
+            break
+
+        if item["kind"] == "start":
+            stored = Embedding.stored_chunks(collection, item["source"])
+            seen, moved = set(), []
+            put(pipe, out_q, item)
+
+        elif item["kind"] == "chunk":
+            chunk = item["chunk"]
+            chunk_id = chunk.metadata["chunk_id"]
+            if chunk_id in seen:
+                continue  # identical text twice in a catalog has one id
+            seen.add(chunk_id)
+
+            if full or chunk_id not in stored:
+                batch.append(chunk)
+                if len(batch) >= batch_size:
+                    flush()
+            elif Embedding.metadata_changed(chunk, stored[chunk_id]):
+                moved.append(chunk)  # same text, new pages / image
+
+        else:
+            flush()
+            put(pipe, out_q, {
+                **item,
+                "added": len(seen - stored.keys()),
+                "kept": len(seen & stored.keys()),
+                "moved": moved,
+                "orphans": list(stored.keys() - seen)
+            })
+
+    flush()
+    put(pipe, out_q, None)
+
+# -------------------------------------------------
+# Stage 5: upsert + per-catalog cleanup
+# -------------------------------------------------
+def upsert_stage(pipe, in_q, storage=Embedding.EMBEDDING_STORAGE):
+    collection = get_collection()
+    totals = pipe["totals"]
+
+    while True:
+        item = get(pipe, in_q)
+        if item is None:
+            break
+
+        if item["kind"] == "vectors":
+            totals["written"] += Embedding.write_embeddings(
+                collection, item["chunks"], item["vectors"], time.time(), storage
+            )
+            if totals["first_searchable"] is None:
+                totals["first_searchable"] = time.perf_counter() - pipe["started"]
+
+        elif item["kind"] == "end":
+            refreshed = Embedding.refresh_metadata(collection, item["moved"], time.time())
+
+            # Chunks of this catalog that no longer exist, removed after the new ones are in
+            orphans = item["orphans"]
+            removed = 0
+            for i in range(0, len(orphans), 1000):
+                removed += collection.delete_many({"chunk_id": {"$in": orphans[i:i + 1000]}}).deleted_count
+
+            totals["added"] += item["added"]
+            totals["kept"] += item["kept"]
+            totals["removed"] += removed
+            print(
+                f"✅ {item['brand']} searchable: {item['pages']} pages, "
+                f"{item['added']} new, {item['kept']} kept ({refreshed} moved), {removed} orphaned chunks"
+            )
+
+# -------------------------------------------------
+# Pipeline
+# -------------------------------------------------
+def run_pipeline(pdf_folder=ingestion.PDF_FOLDER, full=False, queue_size=PIPELINE_QUEUE_SIZE):
+    pdf_paths = [
+        os.path.join(pdf_folder, file)
+        for file in sorted(os.listdir(pdf_folder))
+        if file.lower().endswith(".pdf")
+    ]
+
+    collection = get_collection()
+    collection.create_index("chunk_id")
+    collection.create_index("metadata.source")
+    collection.create_index("metadata.sku")
+    collection.create_index("metadata.model")
+    ingestion.db.prices.create_index("row_key")
+    ingestion.db.prices.create_index("brand")
+    ingestion.db.prices.create_index("sku_key")
+    ingestion.db.prices.create_index("model_key")
+    ingestion.migrate_price_list_csv()
+
+    pipe = {
+        "stop": threading.Event(),
+        "errors": [],
+        "started": time.perf_counter(),
+        "totals": {"written": 0, "added": 0, "kept": 0, "removed": 0, "first_searchable": None}
+    }
+    pages_q, parsed_q, chunks_q, vectors_q = (queue.Queue(maxsize=queue_size) for _ in range(4))
+
+    stages = [
+        ("extract", extract_stage, (pipe, pdf_paths, pages_q)),
+        ("parse", parse_stage, (pipe, pages_q, parsed_q)),
+        ("chunk", chunk_stage, (pipe, parsed_q, chunks_q)),
+        ("embed", embed_stage, (pipe, chunks_q, vectors_q, full)),
+        ("upsert", upsert_stage, (pipe, vectors_q))
+    ]
+
+    def run_stage(name, target, args):
+        try:
+            target(*args)
+        except PipelineStopped:
+            pass
+        except Exception as e:
+            pipe["errors"].append((name, e))
+            pipe["stop"].set()
+
+    threads = [
+        threading.Thread(target=run_stage, args=stage, name=f"pipeline-{stage[0]}", daemon=True)
+        for stage in stages
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if pipe["errors"]:
+        name, error = pipe["errors"][0]
+        raise RuntimeError(f"❌ Pipeline stage '{name}' failed: {error}") from error
+
+    # Sources whose text file is gone (same guarded sweep as Embedding.sync_embeddings)
+    current = {
+        Embedding.text_source(os.path.splitext(os.path.basename(pdf_path))[0], ingestion.TEXT_OUTPUT_FOLDER)
+        for pdf_path in pdf_paths
+    }
+    totals = pipe["totals"]
+    totals["removed"] += Embedding.remove_deleted_sources(collection, current)
+
+    ingestion.evict_ocr_cache()
+
+    elapsed = time.perf_counter() - pipe["started"]
+    first = totals["first_searchable"]
+    print(
+        f"\nPipeline finished in {elapsed:.1f}s: {len(pdf_paths)} catalogs, "
+        f"{totals['added']} added, {totals['kept']} kept, {totals['removed']} removed, "
+        f"{totals['written']} embeddings written"
+        + (f", first chunks searchable after {first:.1f}s" if first is not None else "")
+    )
+    if METRICS_ENABLED:
+        print(f"⏱ Stage timings:\n{summary()}")
+
+    return totals
+
+# ---------------- RUN ----------------
+if __name__ == "__main__":
+    print("\n🔥 STREAMING INGESTION STARTED\n")
+    run_pipeline(full="--full" in sys.argv)
+    print("\n🎉 STREAMING INGESTION COMPLETED\n")
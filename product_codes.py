@@ -0,0 +1,52 @@
+"""
+SKU / model code normalization shared by ingestion, Embedding and Retrieval,
+so codes written to db.prices and chunk metadata match codes found in queries.
+"""
+
+import re
+
+code_token_pattern = re.compile(r"\b(?=[a-z0-9\-]*\d)[a-z0-9][a-z0-9\-]{2,}\b", re.I)
+
+# Numbers with a unit or currency ("230v", "12w", "4000k", "rs500", "ip65") are specs, not codes
+measurement_pattern = re.compile(
+    r"^(?:\d+(?:v|vac|vdc|w|kw|k|mm|cm|m|lm|lx|hz|a|ma|mah|ah|kg|g|va|hp|pcs)"
+    r"|(?:rs|inr|ip)\d+)$"
+)
+
+# Bare numbers shorter than this are quantities or prices; longer ones may be SKUs
+MIN_NUMERIC_CODE = 5
+
+def normalize_code(value):
+    return re.sub(r"[^A-Z0-9]", "", str(value).upper())
+
+def is_code(value):
+    # "LD-98", "X2000", "915005" yes; "500", "230v", "ip65" no
+    key = normalize_code(value)
+    if len(key) < 3 or not any(c.isdigit() for c in key):
+        return False
+    if key.isdigit():
+        return len(key) >= MIN_NUMERIC_CODE
+    return not measurement_pattern.match(key.lower())
+
+def product_key(value):
+    # "915005 LED downlight" -> "915005", "- LD-98 slim" -> "LD98"
+    if not isinstance(value, str):
+        return ""
+
+    for token in value.split():
+        key = normalize_code(token)
+        if key:
+            return key
+    return ""
+
+def extract_codes(text):
+    # SKU / model shaped tokens: "LD98", "915005", "X-2000".
+    # Bare numbers are only candidates; Retrieval confirms them against db.prices.
+    codes = []
+    for token in code_token_pattern.findall(text):
+        if not is_code(token):
+            continue
+        code = normalize_code(token)
+        if code not in codes:
+            codes.append(code)
+    return codes
@@ -0,0 +1,103 @@
+"""
+Compact embedding storage.
+
+EMBEDDING_STORAGE selects how store_embeddings writes vectors:
+  float  - "embedding" as a list of BSON doubles (original format)
+  int8   - "embedding_q": int8 scalar-quantized vector (BSON binary vector)
+  binary - "embedding_q": sign bits packed 8 per byte (BSON binary vector)
+
+In the compact modes a float32 copy is kept in "embedding_f32" (BSON binary,
+not indexed) so the top candidates of the first pass can be rescored at full
+precision. Atlas needs a vector index on embedding_q (VECTOR_INDEX_Q).
+
+Binary codes keep one bit per dimension and need a wider first pass than
+int8 for the same recall, so the default RESCORE_FACTOR depends on the kind
+(4 for int8, 16 for binary). Setting RESCORE_FACTOR overrides both.
+"""
+
+import os
+import numpy as np
+from bson.binary import Binary, BinaryVectorDtype
+
+EMBEDDING_STORAGE = os.getenv("EMBEDDING_STORAGE", "float").lower()
+VECTOR_INDEX_Q = os.getenv("VECTOR_INDEX_Q", "vector_index_q")
+# First-pass candidates per requested result (unset = per-kind default below)
+RESCORE_FACTOR_OVERRIDE = os.getenv("RESCORE_FACTOR")
+DEFAULT_RESCORE_FACTORS = {"int8": 4, "binary": 16}
+
+def rescore_factor(kind=EMBEDDING_STORAGE):
+    if RESCORE_FACTOR_OVERRIDE:
+        return int(RESCORE_FACTOR_OVERRIDE)
+    return DEFAULT_RESCORE_FACTORS.get(kind, 4)
+
+RESCORE_FACTOR = rescore_factor()
+
+def quantize_int8(vectors):
+    # Per-vector max-abs scaling; cosine similarity is unaffected by the scale
+    vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+    scale = np.abs(vectors).max(axis=1, keepdims=True)
+    scale[scale == 0] = 1
+    return np.round(vectors / scale * 127).astype(np.int8)
+
+def quantize_binary(vectors):
+    vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+    return np.packbits(vectors > 0, axis=1)
+
+# Set bits per byte value, for NumPy versions without bitwise_count
+POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+def hamming_similarity(codes, query_code):
+    # Matching bits between packed codes (higher is closer)
+    bits = codes.shape[1] * 8
+    differing = np.bitwise_xor(codes, query_code)
+    if hasattr(np, "bitwise_count"):  # NumPy >= 2.0
+        if differing.shape[1] % 8 == 0:
+            differing = differing.view(np.uint64)  # popcount 64 bits at a time
+        differing = np.bitwise_count(differing).sum(axis=1, dtype=np.int32)
+    else:
+        differing = POPCOUNT[differing].sum(axis=1, dtype=np.int32)
+    return bits - differing
+
+def compact_fields(vector, storage=EMBEDDING_STORAGE):
+    vector = np.asarray(vector, dtype=np.float32)
+    if storage == "int8":
+        code = Binary.from_vector(quantize_int8(vector)[0].tolist(), BinaryVectorDtype.INT8)
+    elif storage == "binary":
+        code = Binary.from_vector(quantize_binary(vector)[0].tolist(), BinaryVectorDtype.PACKED_BIT)
+    else:
+        raise ValueError(f"Unknown EMBEDDING_STORAGE: {storage}")
+
+    return {
+        "embedding_q": code,
+        "embedding_f32": Binary.from_vector(vector.tolist(), BinaryVectorDtype.FLOAT32)
+    }
+
+def query_code(query_vector, storage=EMBEDDING_STORAGE):
+    return compact_fields(query_vector, storage)["embedding_q"]
+
+def stored_vector(doc):
+    # Full-precision vector from either storage format
+    if doc.get("embedding_f32") is not None:
+        return np.asarray(doc["embedding_f32"].as_vector().data, dtype=np.float32)
+    return np.asarray(doc["embedding"], dtype=np.float32)
+
+def rescore(results, query_vector, k):
+    # Exact cosine on the first-pass candidates; same scale as Atlas: (1 + cos) / 2
+    if not results:
+        return []
+
+    query = np.asarray(query_vector, dtype=np.float32)
+    matrix = np.stack([stored_vector(r) for r in results])
+    norms = np.linalg.norm(matrix, axis=1) * (np.linalg.norm(query) or 1)
+    norms[norms == 0] = 1
+    cosine = matrix @ query / norms
+
+    best = np.argsort(-cosine)[:k]
+    rescored = []
+    for i in best:
+        r = dict(results[i])
+        r.pop("embedding_f32", None)
+        r.pop("embedding", None)
+        r["score"] = float((1 + cosine[i]) / 2)
+        rescored.append(r)
+    return rescored
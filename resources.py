@@ -0,0 +1,113 @@
+"""
+Shared, lazily created resources: MongoDB client, embedding model and LLM.
+
+Each resource is built on first use, once per process, and shared by
+Retrieval, Embedding, answer_gen, History_aware and service. Call warm_up() to build
+them up front (app.py does this behind st.cache_resource); per-component
+startup times are kept in startup_timings.
+"""
+
+import os
+import time
+import threading
+from dotenv import load_dotenv
+
+load_dotenv()
+MONGODB_URI = os.getenv("MONGODB_URI")
+
+EMBEDDING_MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+LLM_MODEL_NAME = "llama-3.3-70b-versatile"
+
+instances = {}
+startup_timings = {}
+lock = threading.RLock()
+
+def shared(name, factory):
+    if name in instances:
+        return instances[name]
+
+    with lock:
+        if name not in instances:
+            start = time.perf_counter()
+            instances[name] = factory()
+            startup_timings[name] = time.perf_counter() - start
+            print(f"[startup] {name} ready in {startup_timings[name]:.2f}s")
+
+    return instances[name]
+
+# -------------------------------------------------
+# MongoDB
+# -------------------------------------------------
+def mongo_configured():
+    return bool(MONGODB_URI)
+
+def get_mongo_client():
+    def connect():
+        if not MONGODB_URI:
+            raise EnvironmentError("MONGODB_URI not found in .env file")
+
+        from pymongo import MongoClient
+        try:
+            return MongoClient(MONGODB_URI)
+        except Exception as e:
+            raise ConnectionError(f"Failed to connect to MongoDB: {e}")
+
+    return shared("mongo", connect)
+
+def get_db():
+    return get_mongo_client()["catalog_db"]
+
+def get_async_db():
+    # PyMongo's asyncio client; must be first used on the event loop that serves it (service.py)
+    def connect():
+        if not MONGODB_URI:
+            raise EnvironmentError("MONGODB_URI not found in .env file")
+
+        from pymongo import AsyncMongoClient
+        return AsyncMongoClient(MONGODB_URI)
+
+    return shared("async_mongo", connect)["catalog_db"]
+
+def get_collection():
+    return get_db()["Embeddings"]
+
+# -------------------------------------------------
+# Embedding model
+# -------------------------------------------------
+def get_embedding_model():
+    def load():
+        from langchain_huggingface import HuggingFaceEmbeddings
+        return HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL_NAME)
+
+    return shared("embedding_model", load)
+
+# -------------------------------------------------
+# LLM
+# -------------------------------------------------
+def get_llm():
+    def load():
+        from langchain_groq import ChatGroq
+        return ChatGroq(model=LLM_MODEL_NAME, temperature=0)
+
+    return shared("llm", load)
+
+# -------------------------------------------------
+# Warm-up
+# -------------------------------------------------
+def warm_up(mongo=True, embedding_model=True, llm=True):
+    start = time.perf_counter()
+
+    if mongo and mongo_configured():
+        # MongoClient connects lazily; ping so the first query does not pay for it
+        get_mongo_client().admin.command("ping")
+    if embedding_model:
+        # The first encode call initializes the tokenizer and weights
+        get_embedding_model().embed_query("warm up")
+    if llm:
+        get_llm()
+
+    print(f"[startup] warm-up finished in {time.perf_counter() - start:.2f}s: {startup_report()}")
+    return dict(startup_timings)
+
+def startup_report():
+    return ", ".join(f"{name}={seconds:.2f}s" for name, seconds in startup_timings.items())
@@ -0,0 +1,376 @@
+"""
+Asyncio serving layer for retrieval and answer generation.
+
+One event loop (on a background thread) serves every Streamlit session in
+the process:
+  - vector search and exact lookups use PyMongo's async client; query
+    embedding and the local index run on worker threads
+  - identical in-flight requests are coalesced: one retrieval per
+    (query, k) and one LLM call per identical prompt + history, with the
+    streamed tokens replayed to every waiter
+  - at most LLM_MAX_CONCURRENCY LLM calls run at once; up to
+    LLM_MAX_QUEUE more wait (for at most LLM_QUEUE_TIMEOUT seconds) and
+    anything beyond that is rejected with ServiceBusy
+  - turns of one session are answered one at a time, in order
+
+ask() is the blocking entry point used by app.py.
+"""
+
+import os
+import time
+import asyncio
+import hashlib
+import threading
+import concurrent.futures
+from langchain_core.messages import HumanMessage
+import answer_gen
+from Retrieval import (RETRIEVAL_BACKEND, EXACT_LOOKUP, RESULT_PROJECTION, embed_query,
+                       normalize_query, atlas_pipeline, atlas_results, local_search,
+                       price_code_filter, PRICE_CODE_PROJECTION, confirmed_codes,
+                       exact_chunk_filter, merge_exact, format_results)
+from product_codes import extract_codes
+from resources import shared, mongo_configured, get_async_db, get_llm
+from context_packer import estimate_tokens
+from metrics import METRICS_ENABLED, span, count, observe, count_tokens
+
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "4"))
+LLM_MAX_QUEUE = int(os.getenv("LLM_MAX_QUEUE", "32"))
+LLM_QUEUE_TIMEOUT = float(os.getenv("LLM_QUEUE_TIMEOUT", "30"))
+# Seconds a blocking caller waits for retrieval or for the next token
+SERVICE_TIMEOUT = float(os.getenv("SERVICE_TIMEOUT", "120"))
+
+class ServiceBusy(Exception):
+    pass
+
+class SharedStream:
+    """Tokens of one generation, replayed from the start to every subscriber."""
+
+    def __init__(self):
+        self.tokens = []
+        self.done = False
+        self.error = None
+        self.updated = asyncio.Event()
+
+    def append(self, token):
+        self.tokens.append(token)
+        self.notify()
+
+    def close(self, error=None):
+        self.done = True
+        self.error = error
+        self.notify()
+
+    def notify(self):
+        self.updated.set()
+        self.updated = asyncio.Event()
+
+    def text(self):
+        return "".join(self.tokens)
+
+    async def subscribe(self):
+        i = 0
+        while True:
+            while i < len(self.tokens):
+                yield self.tokens[i]
+                i += 1
+            if self.done:
+                if self.error:
+                    raise self.error
+                return
+            await self.updated.wait()
+
+# -------------------------------------------------
+# Event loop (one per process)
+# -------------------------------------------------
+def get_loop():
+    def start():
+        loop = asyncio.new_event_loop()
+        threading.Thread(target=loop.run_forever, name="catalog-service", daemon=True).start()
+        return loop
+
+    return shared("service_loop", start)
+
+def run(coro, timeout=SERVICE_TIMEOUT):
+    future = asyncio.run_coroutine_threadsafe(coro, get_loop())
+    try:
+        return future.result(timeout)
+    except concurrent.futures.TimeoutError:
+        # Cancel the coroutine as well: a turn still waiting for its session or for
+        # retrieval never reaches the LLM. A running generation is left to the turn's
+        # complete(), which does not record it once the caller has given up (see ask()).
+        future.cancel()
+        raise ServiceBusy("The assistant is taking too long, please try again.")
+
+# Created on the service loop's thread (asyncio primitives belong to one loop)
+state = {}
+
+def service_state():
+    if not state:
+        state.update({
+            "llm_slots": asyncio.Semaphore(LLM_MAX_CONCURRENCY),
+            "llm_waiting": 0,
+            "retrievals": {},   # (query, k) -> task
+            "generations": {},  # prompt key -> SharedStream
+            "session_locks": {}  # session id -> {"lock": asyncio.Lock, "users": int}
+        })
+    return state
+
+async def acquire_session(session_id):
+    # A session's lock lives while any turn holds or waits for it, then is dropped
+    locks = service_state()["session_locks"]
+    entry = locks.get(session_id)
+    if entry is None:
+        entry = locks[session_id] = {"lock": asyncio.Lock(), "users": 0}
+
+    entry["users"] += 1
+    try:
+        await entry["lock"].acquire()
+    except BaseException:
+        release_session(session_id, entry, locked=False)
+        raise
+    return entry
+
+def release_session(session_id, entry, locked=True):
+    if locked:
+        entry["lock"].release()
+    entry["users"] -= 1
+    if not entry["users"]:
+        service_state()["session_locks"].pop(session_id, None)
+
+# -------------------------------------------------
+# Retrieval
+# -------------------------------------------------
+async def search(query, k):
+    query_vector = await asyncio.to_thread(embed_query, query)
+
+    with span("vector_search", backend=RETRIEVAL_BACKEND, caller="service"):
+        if RETRIEVAL_BACKEND == "atlas":
+            cursor = await get_async_db()["Embeddings"].aggregate(atlas_pipeline(query_vector, k))
+            results = atlas_results(await cursor.to_list(None), query_vector, k)
+        else:
+            results = await asyncio.to_thread(local_search, query_vector, k)
+
+    codes = extract_codes(query) if EXACT_LOOKUP else []
+    if codes and mongo_configured():
+        with span("exact_lookup", caller="service"):
+            db = get_async_db()
+            numeric = [c for c in codes if c.isdigit()]
+            if numeric:
+                records = await db["prices"].find(price_code_filter(numeric), PRICE_CODE_PROJECTION).to_list(None)
+                codes = confirmed_codes(codes, records)
+            exact = await db["Embeddings"].find(
+                exact_chunk_filter(codes), RESULT_PROJECTION
+            ).limit(k).to_list(None) if codes else []
+        if exact:
+            results = merge_exact(results, exact, k)
+
+    return format_results(results)
+
+async def retrieve(query, k=5):
+    # Concurrent identical queries share one search
+    retrievals = service_state()["retrievals"]
+    key = (normalize_query(query), k)
+
+    task = retrievals.get(key)
+    if task is None:
+        task = asyncio.ensure_future(search(query, k))
+        retrievals[key] = task
+        task.add_done_callback(lambda _: retrievals.pop(key, None))
+    else:
+        count("coalesced", kind="retrieval")
+
+    # Results are shared, so each caller gets its own copies
+    return [dict(d) for d in await asyncio.shield(task)]
+
+# -------------------------------------------------
+# Generation
+# -------------------------------------------------
+def prompt_key(messages):
+    digest = hashlib.sha256()
+    for m in messages:
+        digest.update(f"{m.type}\0{m.content}\0".encode("utf-8"))
+    return digest.hexdigest()
+
+async def stream_llm(messages, stream):
+    # llm_waiting was incremented by generate()
+    current = service_state()
+    queued_at = time.perf_counter()
+    try:
+        await asyncio.wait_for(current["llm_slots"].acquire(), LLM_QUEUE_TIMEOUT)
+    except asyncio.TimeoutError:
+        count("rejected", reason="queue_timeout")
+        stream.close(ServiceBusy("The assistant is busy, please try again in a moment."))
+        return
+    finally:
+        current["llm_waiting"] -= 1
+    observe("llm_queue_wait_seconds", time.perf_counter() - queued_at)
+
+    usage = None
+    try:
+        with span("generation", caller="service"):
+            async for chunk in get_llm().astream(messages):
+                usage = getattr(chunk, "usage_metadata", None) or usage
+                if chunk.content:
+                    stream.append(chunk.content)
+        stream.close()
+    except Exception as e:
+        stream.close(e)
+    finally:
+        current["llm_slots"].release()
+
+    if METRICS_ENABLED:
+        count_tokens(
+            usage,
+            sum(estimate_tokens(m.content) for m in messages),
+            estimate_tokens(stream.text()),
+            caller="service"
+        )
+
+def generate(messages):
+    # Identical prompts (same history + question + context) share one LLM call
+    current = service_state()
+    generations = current["generations"]
+    key = prompt_key(messages)
+
+    stream = generations.get(key)
+    if stream is not None:
+        count("coalesced", kind="generation")
+        return stream
+
+    if current["llm_waiting"] >= LLM_MAX_QUEUE:
+        count("rejected", reason="queue_full")
+        raise ServiceBusy("The assistant is busy, please try again in a moment.")
+
+    current["llm_waiting"] += 1
+    stream = generations[key] = SharedStream()
+    task = asyncio.ensure_future(stream_llm(messages, stream))
+    task.add_done_callback(lambda _: generations.pop(key, None))
+    return stream
+
+async def record(session_id, query, text):
+    # History summaries go through generate(), so they count against the LLM limits
+    dropped = answer_gen.record_turn(session_id, query, text, summarize=False)
+    if not dropped:
+        return
+
+    session = answer_gen.get_session(session_id)
+    try:
+        with span("history_summary", caller="service"):
+            stream = generate(answer_gen.summary_messages(session["summary"], dropped))
+            async for _ in stream.subscribe():
+                pass
+        session["summary"] = stream.text().strip()
+    except Exception:
+        # LLM busy or failing: keep the turns, they are summarized after a later turn
+        session["turns"][:0] = dropped
+        count("summary_deferred")
+
+def finished(text):
+    stream = SharedStream()
+    stream.append(text)
+    stream.close()
+    return stream
+
+async def caller_read_all(delivered):
+    # True once the caller has read the whole answer, False if it gave up or never reads it
+    try:
+        return await asyncio.wait_for(asyncio.shield(delivered), SERVICE_TIMEOUT)
+    except asyncio.TimeoutError:
+        return False
+
+async def answer(query, session_id="default", k=5):
+    # Returns (docs, SharedStream, delivered). An LLM answer is recorded once the
+    # caller reports through delivered (a future, None otherwise) that it read it all.
+    start = time.perf_counter()
+    session = await acquire_session(session_id)
+    handed_over = False
+
+    try:
+        if answer_gen.DIRECT_ANSWERS:
+            direct = await asyncio.to_thread(answer_gen.direct_answer, query)
+            if direct:
+                await record(session_id, query, direct[0])
+                answer_gen.log_latency(query, start, None, "direct")
+                return direct[1], finished(direct[0]), None
+
+        docs = await retrieve(query, k)
+        if not docs:
+            return [], finished("No relevant catalog data found in the catalog."), None
+
+        query_vector = await asyncio.to_thread(embed_query, query)
+        signature = answer_gen.answer_signature(docs, session_id)
+        cached = answer_gen.cached_answer(signature, query_vector)
+        if cached is not None:
+            await record(session_id, query, cached)
+            answer_gen.log_latency(query, start, None, "cache")
+            return docs, finished(cached), None
+
+        messages = answer_gen.history_messages(session_id) + [
+            HumanMessage(content=answer_gen.build_prompt(query, docs))
+        ]
+        stream = generate(messages)
+        delivered = asyncio.get_running_loop().create_future()
+
+        async def complete():
+            try:
+                first_token_at = None
+                async for _ in stream.subscribe():
+                    first_token_at = first_token_at or time.perf_counter()
+                if not await caller_read_all(delivered):
+                    count("abandoned", kind="answer")
+                    return  # the user never saw the whole answer: not history, not cached
+                text = stream.text()
+                await record(session_id, query, text)
+                answer_gen.cache_answer(signature, query_vector, text)
+                answer_gen.log_latency(query, start, first_token_at, "llm")
+            except Exception:
+                pass  # the error reaches the caller through the stream
+            finally:
+                release_session(session_id, session)
+
+        asyncio.ensure_future(complete())
+        handed_over = True  # complete() releases the session lock
+        return docs, stream, delivered
+    finally:
+        if not handed_over:
+            release_session(session_id, session)
+
+# -------------------------------------------------
+# Blocking client API (Streamlit)
+# -------------------------------------------------
+async def next_token(subscription):
+    return await subscription.__anext__()
+
+async def ping():
+    await get_async_db().command("ping")
+
+def warm_up():
+    # The async client connects lazily; connect it on the service loop up front
+    if mongo_configured():
+        run(ping())
+
+def ask(query, session_id="default", k=5, timeout=SERVICE_TIMEOUT):
+    # (docs, tokens): docs as soon as retrieval finishes, tokens as a blocking iterator.
+    # Raises ServiceBusy when the LLM queue is full or a step takes longer than timeout.
+    docs, stream, delivered = run(answer(query, session_id, k), timeout)
+    loop = get_loop()
+
+    def report(read_all):
+        if delivered is not None:
+            loop.call_soon_threadsafe(lambda: delivered.done() or delivered.set_result(read_all))
+
+    def tokens():
+        subscription = stream.subscribe()
+        read_all = False
+        try:
+            while True:
+                try:
+                    yield run(next_token(subscription), timeout)
+                except StopAsyncIteration:
+                    read_all = True
+                    return
+        finally:
+            # Timed out, failed or closed early: the turn is not recorded
+            report(read_all)
+
+    return docs, tokens()
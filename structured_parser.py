@@ -0,0 +1,131 @@
+"""
+Structured-data parser for extracted catalog text.
+
+Patterns are compiled once per parser. A single combined multiline scan
+over the whole document yields only the lines that can matter (SKU, model,
+price or spec lines), so the per-line checks never run on the bulk of the
+OCR text. Brands with different catalog layouts can register their own
+parser with register_parser(). structured_stream() parses page by page
+(streaming ingestion) with the same records as a whole-document parse.
+
+Record output matches the original line-by-line loop in
+ingestion.extract_structured_data; see benchmarks/bench_structured_parser.py.
+"""
+
+import re
+from product_codes import product_key
+
+DEFAULT_PRICE_PATTERN = r"(₹\s?\d+[,\d]*\.?\d*|Rs\.?\s?\d+[,\d]*\.?\d*)"
+DEFAULT_SKU_PATTERN = r"(SKU[:\s\-]*[A-Z0-9\-]+)"
+DEFAULT_MODEL_PATTERN = r"(Model[:\s\-]*[A-Z0-9\-]+)"
+DEFAULT_SPEC_KEYWORDS = ["watt", "volt", "mm", "kg", "capacity", "power"]
+# Prefilter for the default patterns, matched against the lower-cased text: every
+# line any of them can match contains one of these literals ([^\S\n] keeps a match
+# on one line, like the per-line \s in the price pattern)
+DEFAULT_CANDIDATE_PATTERN = r"₹|rs\.?[^\S\n]?\d|sku|model|watt|volt|mm|kg|capacity|power"
+
+def make_parser(price_pattern=DEFAULT_PRICE_PATTERN, sku_pattern=DEFAULT_SKU_PATTERN,
+                model_pattern=DEFAULT_MODEL_PATTERN, spec_keywords=DEFAULT_SPEC_KEYWORDS,
+                candidate_pattern=None):
+    price_re = re.compile(price_pattern)
+    sku_re = re.compile(sku_pattern, re.I)
+    model_re = re.compile(model_pattern, re.I)
+    spec_re = re.compile("|".join(re.escape(k.lower()) for k in spec_keywords))
+    sku_strip_re = re.compile(r"SKU|:", re.I)
+    model_strip_re = re.compile(r"Model|:", re.I)
+
+    # A line that does not match the candidate pattern cannot change the parser
+    # state, so it is never looked at again. Without an explicit (faster, literal)
+    # prefilter, fall back to the case-insensitive union of all patterns.
+    if candidate_pattern is None:
+        candidate_pattern = "(?i:%s)" % "|".join([price_pattern, sku_pattern, model_pattern, spec_re.pattern])
+    candidate_re = re.compile(candidate_pattern)
+    candidate_re_ci = re.compile(candidate_pattern, re.I)
+
+    def candidate_lines(text):
+        haystack, scanner = text.lower(), candidate_re
+        if len(haystack) != len(text):
+            # Some Unicode characters change length when lower-cased, which would shift offsets
+            haystack, scanner = text, candidate_re_ci
+
+        pos = 0
+        while True:
+            match = scanner.search(haystack, pos)
+            if not match:
+                return
+            # Only the line the match starts on: a pattern with \s can run on into the
+            # next line, which is scanned again on its own
+            start = text.rfind("\n", 0, match.start()) + 1
+            end = text.find("\n", match.start())
+            if end == -1:
+                end = len(text)
+            yield text[start:end]
+            pos = end + 1
+
+    def new_record(brand_name):
+        return {"brand": brand_name, "product_name": "", "sku": "", "price": "", "specs": []}
+
+    def resume(text, brand_name, current, products):
+        # Continue from an unfinished record; completed records go to products
+        for line in candidate_lines(text):
+            line = line.strip()
+
+            if sku_re.search(line):
+                current["sku"] = sku_strip_re.sub("", line).strip()
+
+            if model_re.search(line):
+                current["product_name"] = model_strip_re.sub("", line).strip()
+
+            price_match = price_re.search(line)
+            if price_match:
+                current["price"] = price_match.group()
+                current["specs"] = "; ".join(current["specs"])
+                # Normalized codes for exact SKU / model lookups (see Retrieval.lookup_products)
+                current["sku_key"] = product_key(current["sku"])
+                current["model_key"] = product_key(current["product_name"])
+                products.append(current)
+                current = new_record(brand_name)
+                continue
+
+            if spec_re.search(line.lower()):
+                current["specs"].append(line)
+
+        return current
+
+    def parse(text, brand_name):
+        products = []
+        resume(text, brand_name, new_record(brand_name), products)
+        return products
+
+    parse.resume = resume
+    parse.new_record = new_record
+    return parse
+
+# -------------------------------------------------
+# Per-brand registry
+# -------------------------------------------------
+default_parser = make_parser(candidate_pattern=DEFAULT_CANDIDATE_PATTERN)
+PARSERS = {}
+
+def register_parser(brand_name, parser):
+    # Parsers built with make_parser() also support structured_stream()
+    PARSERS[brand_name.lower()] = parser
+
+def get_parser(brand_name):
+    return PARSERS.get(brand_name.lower(), default_parser)
+
+def parse_structured_text(text, brand_name):
+    return get_parser(brand_name)(text, brand_name)
+
+def structured_stream(brand_name):
+    # feed(text) for each page in order returns the records that page completes.
+    # Pages must end on a line boundary, as the "--- Page N ---" blocks do.
+    parser = get_parser(brand_name)
+    state = {"current": parser.new_record(brand_name)}
+
+    def feed(text):
+        products = []
+        state["current"] = parser.resume(text, brand_name, state["current"], products)
+        return products
+
+    return feed
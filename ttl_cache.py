@@ -0,0 +1,94 @@
+"""
+Thread-safe LRU cache with per-entry TTL, hit/miss counters and optional
+JSON persistence. Used for query embeddings (Retrieval.py), answers and
+chat sessions (answer_gen.py). With touch=True a hit restarts the entry's
+TTL, so entries expire after a period of inactivity instead of a fixed age.
+"""
+
+import os
+import json
+import time
+import threading
+from collections import OrderedDict
+
+class TTLCache:
+    def __init__(self, max_size=1024, ttl=None, touch=False):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.touch = touch
+        self.entries = OrderedDict()  # key -> (stored_at, value)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def expired(self, stored_at, now):
+        return self.ttl is not None and now - stored_at > self.ttl
+
+    def get(self, key, default=None):
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or self.expired(entry[0], now):
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return default
+
+            if self.touch:
+                self.entries[key] = (now, entry[1])
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.time(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+        return entry[1] if entry else default
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0
+            }
+
+    # ---------------- persistence ----------------
+    def save(self, path):
+        with self.lock:
+            items = [[key, stored_at, value] for key, (stored_at, value) in self.entries.items()]
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(items, f)
+        os.replace(tmp_path, path)
+
+    def load(self, path):
+        if not os.path.exists(path):
+            return 0
+
+        with open(path, "r", encoding="utf-8") as f:
+            items = json.load(f)
+
+        now = time.time()
+        with self.lock:
+            for key, stored_at, value in items:
+                if not self.expired(stored_at, now):
+                    self.entries[key] = (stored_at, value)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+            return len(self.entries)